@@ -1,19 +1,56 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Usage example: compress.py ParameterSpacePoint(4+0+0+0.5+1+0.3+0+1+0+80+0+10+0+128+50+200+150+30+0+1+5+2) [clean_up={0|1}]"""
+"""Usage example: compress.py ParameterSpacePoint(4+0+0+0.5+1+0.3+0+1+0+80+0+10+0+128+50+200+150+30+0+1+5+2) [clean_up={0|1}]
+
+The tar archives of the simulations are read in memory and decoded by
+a pool of worker processes (as many as the NSLOTS environment
+variable says, or one per CPU if it's not set), while the main process
+appends their contents to the spike archive.
+"""
 import sys
 import os
 import os.path
 import shutil
 import time
-import tarfile
-import h5py
-import networkx
+import multiprocessing
+import collections
 import numpy as np
 
 from utils.parameters import ParameterSpacePoint
 from utils.cluster_system import ClusterSystem
-from utils.archival import create_chunked_spike_dataset
+from utils.archival import create_csr_spike_datasets, append_csr_trains, load_tar_simulation_spikes, create_sparse_adjacency_datasets
+
+def load_pattern_spikes(job):
+    """Worker function: load and decode the spikes for all the trials
+    of a stimulus pattern."""
+    spn, tar_path, sim_refs = job
+    compression_attempts = 0
+    max_compression_attempts = 10
+    while compression_attempts < max_compression_attempts:
+        try:
+            trials, n_bytes = load_tar_simulation_spikes(tar_path, sim_refs)
+            return spn, trials, n_bytes
+        except KeyError as e:
+            compression_attempts += 1
+            print ("Missing dataset! retrying. Error was: {}".format(e))
+            time.sleep(10)
+        except IOError as e:
+            compression_attempts += 1
+            print ("Missing file! retrying. Error was: {}".format(e))
+            time.sleep(10)
+    raise Exception("Giving up on compressing data for stim pattern number {}".format(spn))
+
+def bounded_imap(pool, function, jobs, max_in_flight):
+    """Same as pool.imap, but submit new jobs only as the results are
+    consumed, so that no more than max_in_flight results are ever
+    held in memory waiting to be consumed."""
+    in_flight = collections.deque()
+    for job in jobs:
+        in_flight.append(pool.apply_async(function, (job,)))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
 
 point = eval(sys.argv[1].replace('+', ','))
 
@@ -33,6 +70,12 @@ for stim_pattern_number in range(point.n_stim_patterns):
 if any(missing_tar_archives):
     raise Exception("Point: {}\nCompression step can't start due to {} missing tar spike archives out of {}. Missing files:\n{}".format(point, len(missing_tar_archives), point.n_stim_patterns, missing_tar_archives))
 
+# start the worker processes before opening any hdf5 file, so that
+# they don't inherit open file handles.
+n_workers = int(os.environ.get('NSLOTS', multiprocessing.cpu_count()))
+print("Decoding simulation data with {} worker processes".format(n_workers))
+pool = multiprocessing.Pool(n_workers)
+
 with ClusterSystem() as system:
     # override archive location to work in temporary directory
     permanent_archive_path = point.spikes_arch.path
@@ -45,11 +88,12 @@ with ClusterSystem() as system:
     archive.attrs['n_stim_patterns'] = point.n_stim_patterns
     archive.attrs['n_trials'] = point.n_trials
     archive.attrs['sim_duration'] = point.sim_duration
+    archive.attrs['spike_layout'] = 'csr'
 
-    # load network description from graphml file and save it in the hdf5 file
-    network_adjacency_matrix = networkx.to_numpy_matrix(point.network_graph)
+    # save the network description in the hdf5 file. Only the
+    # MF->GrC block of the adjacency matrix is stored, in sparse form.
+    create_sparse_adjacency_datasets(archive, point.network_structure.adjacency)
     cell_positions = point.get_cell_positions()
-    archive.create_dataset("network_adjacency_matrix", data=network_adjacency_matrix)
     archive.create_dataset("cell_positions_MFs", data=cell_positions['MFs'])
     archive.create_dataset("cell_positions_GrCs", data=cell_positions['GrCs'])
 
@@ -58,50 +102,41 @@ with ClusterSystem() as system:
     stim_patterns = [[int(mf) for mf in line.split(' ')[0:-1]] for line in spf.readlines()]
     spf.close()
 
+    # prepare the datasets that will hold the spikes of all
+    # observations, in CSR format
+    create_csr_spike_datasets(archive, 'mf', point.n_mf, point.spikes_arch.compression)
+    create_csr_spike_datasets(archive, 'grc', point.n_grc, point.spikes_arch.compression)
+
     for spn, sp in enumerate(stim_patterns):
         # load stimulus pattern from txt file and save it in the hdf5 file
         archive.create_group("%03d" % spn)
         stim = np.array(sp, dtype=np.int)
         archive["%03d" % spn].create_dataset("stim_pattern", data=stim)
 
-        # untar simulation data archive to temporary directory
-        with tarfile.open(point.get_tar_simulation_archive_path(spn)) as tar_archive:
-            print('Extracting tar archive {} to temporary directory {}'.format(point.get_tar_simulation_archive_path(spn), system.work_dir))
-            tar_archive.extractall(system.work_dir)
-
-        for trial in range(point.n_trials):
-            print (spn, trial)
-            sim_ref = point.get_simulation_reference(spn, trial)
-            sim_data_path = system.work_dir + "/" + sim_ref + "_.h5"
-            archive["%03d" % spn].create_group("%02d" % trial)
-            target_data_group = archive["%03d" % spn]["%02d" % trial]
-
-            compression_attempts = 0
-            max_compression_attempts = 10
-            while compression_attempts < max_compression_attempts:
-                try:
-                    with h5py.File(sim_data_path) as spike_file:
-                        create_chunked_spike_dataset(target_data_group,
-                                                     'mf_spiketimes',
-                                                     spike_file['MFs']['SPIKE_0'])
-                        create_chunked_spike_dataset(target_data_group,
-                                                     'grc_spiketimes',
-                                                     spike_file['GrCs']['SPIKE_min40'])
-                    break
-                except KeyError as e:
-                    compression_attempts += 1
-                    print ("Missing dataset! retrying. Error was: {}".format(e))
-                    # clean up
-                    for group_name in ['mf_spiketimes', 'grc_spiketimes']:
-                        if group_name in target_data_group:
-                            del target_data_group[group_name]
-                    time.sleep(10)
-                except IOError as e:
-                    compression_attempts += 1
-                    print ("Missing directory! retrying. Error was: {}".format(e))
-                    time.sleep(10)
-            if compression_attempts == max_compression_attempts:
-                raise Exception("Giving up on compressing data for stim pattern number {}".format(spn))
+    # decode simulation data in parallel, and append it to the archive
+    # one pattern at a time, in order. The writer can be slower than
+    # the workers, so the number of patterns being decoded or waiting
+    # to be written is bounded to keep memory usage in check.
+    jobs = [(spn,
+             point.get_tar_simulation_archive_path(spn),
+             [point.get_simulation_reference(spn, trial) for trial in range(point.n_trials)]) for spn in range(point.n_stim_patterns)]
+    start_time = time.time()
+    total_bytes = 0
+    total_spikes = 0
+    for spn, trials, n_bytes in bounded_imap(pool, load_pattern_spikes, jobs, 2*n_workers):
+        for (mf_times, mf_counts), (grc_times, grc_counts) in trials:
+            append_csr_trains(archive, 'mf', mf_times, mf_counts)
+            append_csr_trains(archive, 'grc', grc_times, grc_counts)
+            total_spikes += mf_times.size + grc_times.size
+        total_bytes += n_bytes
+        elapsed = time.time() - start_time
+        print("pattern {}/{} | {:.1f}s elapsed | {:.1f} MB/s read | {:.0f} spikes/s written".format(spn+1,
+                                                                                                 point.n_stim_patterns,
+                                                                                                 elapsed,
+                                                                                                 total_bytes/(1e6*elapsed),
+                                                                                                 total_spikes/elapsed))
+    pool.close()
+    pool.join()
 
     archive.close()
     print("Compression successfully completed!")
@@ -6,6 +6,7 @@
 #$ -l mem=4G
 #$ -l h_rt=10:00:00
 #$ -P gclayer13
+#$ -pe smp 4
 
 args_list=$@
 
@@ -7,6 +7,7 @@
 #$ -l h_rt=7:45:00
 #$ -P gclayer13
 #$ -l tmpfs=15G
+#$ -pe smp 4
 
 # "jobscripts" are things that should be passed to qsub.
 
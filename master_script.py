@@ -34,7 +34,7 @@ sim_duration = psl(3750.) # (s) typically, 3750 when simulating and 180 when ana
 ana_duration = psl(30.0) # (s) when analysing, must be < min(sim_duration). Default: 30
 training_size = psl(30) # when analysing, must be < min(n_trials). Default: 30
 multineuron_metric_mixing = psl(0.)
-linkage_method = psl(1) # 0: ward, 1: kmeans
+linkage_method = psl(1) # 0: ward, 1: kmeans, 2: mini-batch kmeans, 3: kmeans started from class means
 tau = psl(5) # time constant for MUVR metric convolution
 dt = psl(2) # integration time step for old implementation of MUVR metric. Not in use anymore.
 
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare compression policies for spike archives, using the spikes
+stored in an existing archive (in either layout). For every policy,
+report write throughput, read throughput and file size.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_compression_codecs /path/to/sp1024_t1_sdur3750.hdf5
+"""
+import sys
+import os
+import shutil
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from utils.archival import CompressionPolicy, create_csr_spike_datasets, append_csr_trains, read_csr_trains, dense_to_csr_spikes
+
+POLICIES = [CompressionPolicy(codec='gzip', level=1),
+            CompressionPolicy(codec='gzip', level=4),
+            CompressionPolicy(codec='gzip', level=9),
+            CompressionPolicy(codec='lzf'),
+            CompressionPolicy(codec='gzip', level=4, shuffle=True),
+            CompressionPolicy(codec='lzf', shuffle=True),
+            CompressionPolicy(codec='gzip', level=4, delta=True),
+            CompressionPolicy(codec='gzip', level=4, shuffle=True, delta=True)]
+
+def load_observations(path, cell_type):
+    """Return the list of (times, counts) pairs for all the
+    observations of a cell type in the archive."""
+    archive = h5py.File(path, 'r')
+    n_cells = int(archive.attrs['n_'+cell_type])
+    n_obs = int(archive.attrs['n_stim_patterns']) * int(archive.attrs['n_trials'])
+    observations = []
+    if archive.attrs.get('spike_layout', 'dense') == 'csr':
+        times, indptr = read_csr_trains(archive['spikes/{0}'.format(cell_type)], 0, n_obs*n_cells)
+        for o in range(n_obs):
+            obs_indptr = indptr[o*n_cells:(o+1)*n_cells+1]
+            observations.append((times[obs_indptr[0]:obs_indptr[-1]], np.diff(obs_indptr)))
+    else:
+        for spn in range(int(archive.attrs['n_stim_patterns'])):
+            for trial in range(int(archive.attrs['n_trials'])):
+                observations.append(dense_to_csr_spikes(archive['/{0:03d}/{1:02d}/{2}_spiketimes'.format(spn, trial, cell_type)][...]))
+    archive.close()
+    return n_cells, observations
+
+def main():
+    source_path = sys.argv[1]
+    data = dict((cell_type, load_observations(source_path, cell_type)) for cell_type in ['mf', 'grc'])
+    n_spikes = sum(times.size for n_cells, observations in data.values() for times, counts in observations)
+    # size of the uncompressed spike times and pointers
+    raw_mb = sum(times.nbytes + 8*counts.size for n_cells, observations in data.values() for times, counts in observations) / 1e6
+    print('{0}: {1} spikes, {2:.1f}MB uncompressed'.format(source_path, n_spikes, raw_mb))
+    work_dir = tempfile.mkdtemp()
+    try:
+        for k, policy in enumerate(POLICIES):
+            path = os.path.join(work_dir, 'codec{0}.hdf5'.format(k))
+            start = time.time()
+            archive = h5py.File(path, 'w')
+            for cell_type, (n_cells, observations) in data.items():
+                create_csr_spike_datasets(archive, cell_type, n_cells, policy)
+                for times, counts in observations:
+                    append_csr_trains(archive, cell_type, times, counts)
+            archive.close()
+            write_time = time.time() - start
+            start = time.time()
+            archive = h5py.File(path, 'r')
+            for cell_type, (n_cells, observations) in data.items():
+                group = archive['spikes/{0}'.format(cell_type)]
+                read_csr_trains(group, 0, group['indptr'].shape[0]-1)
+            archive.close()
+            read_time = time.time() - start
+            print('{0}\n    write {1:.1f} MB/s | read {2:.1f} MB/s | size {3:.2f}MB'.format(policy,
+                                                                                        raw_mb/write_time,
+                                                                                        raw_mb/read_time,
+                                                                                        os.path.getsize(path)/1e6))
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
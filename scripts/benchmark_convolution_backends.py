@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the 'binned' and 'exact' backends of
+utils.analysis.convolve in speed and accuracy, on synthetic spike
+trains and at the tau/dt values used in master_script.py.
+
+The accuracy of the binned backend is measured against the exact
+backend, evaluated at the end of each time bin. Both the traces and
+the labeled-line distances between observations are compared.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_convolution_backends [n_obs] [n_cells]
+"""
+import sys
+import time
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from utils.analysis import convolve
+
+def synthetic_spikes(n_obs, n_cells, sim_length, rate=0.02, max_n_spikes=10):
+    """Poisson-like spike trains, padded with -1."""
+    spikes = np.random.uniform(0, sim_length, size=(n_obs, n_cells, max_n_spikes))
+    n_spikes = np.random.poisson(rate*sim_length, size=(n_obs, n_cells, 1))
+    spikes[np.arange(max_n_spikes) >= n_spikes] = -1
+    return np.sort(spikes, axis=2)
+
+def main():
+    n_obs = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    n_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 487
+    sim_length = 30.
+    spikes = synthetic_spikes(n_obs, n_cells, sim_length)
+    for tau, dt in [(5, 2), (5, 1), (5, 0.5), (20, 2)]:
+        start = time.time()
+        binned = convolve(spikes, sim_length, tau, dt, backend='binned')
+        binned_time = time.time() - start
+        start = time.time()
+        exact = convolve(spikes, sim_length, tau, dt, backend='exact')
+        exact_time = time.time() - start
+        trace_error = np.sqrt(np.square(binned - exact).sum() / np.square(exact).sum())
+        n_distance_obs = min(n_obs, 200)
+        binned_distances = pdist(binned[:n_distance_obs].reshape(n_distance_obs, -1))
+        exact_distances = pdist(exact[:n_distance_obs].reshape(n_distance_obs, -1))
+        distance_correlation = np.corrcoef(binned_distances, exact_distances)[0,1]
+        print('tau={0} dt={1}: binned {2:.3f}s, exact {3:.3f}s; relative trace error {4:.3f}, distance correlation {5:.4f}'.format(tau, dt, binned_time, exact_time, trace_error, distance_correlation))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the k-means based decoders available in
+ParameterSpacePoint.run_analysis (linkage_method 1, 2 and 3) in
+runtime and decoded MI, on synthetic spike counts with the same
+structure as the ones used in the analysis: n_stim_patterns
+stimuli, n_trials trials per stimulus of which training_size are
+used for training, and as many clusters as stimuli.
+
+MI is estimated with the plugin estimator.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_kmeans_decoders [n_stim_patterns] [n_trials] [n_grc]
+"""
+import sys
+import time
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+def synthetic_spike_counts(n_stim_patterns, n_trials, n_grc, mean_rate=0.5):
+    """Poisson spike counts, with a sparse random mean response for
+    each stimulus pattern. Observations are ordered by stimulus
+    pattern."""
+    mean_counts = np.random.exponential(mean_rate, size=(n_stim_patterns, n_grc)) * (np.random.uniform(size=(n_stim_patterns, n_grc)) < 0.3)
+    return np.random.poisson(np.repeat(mean_counts, n_trials, axis=0)).astype(float)
+
+def plugin_mi(stimuli, decoded_output):
+    joint = np.zeros(shape=(stimuli.max()+1, decoded_output.max()+1))
+    np.add.at(joint, (stimuli, decoded_output), 1)
+    joint /= joint.sum()
+    independent = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+    nonzero = joint > 0
+    return (joint[nonzero] * np.log2(joint[nonzero] / independent[nonzero])).sum()
+
+def main():
+    n_stim_patterns = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    n_grc = int(sys.argv[3]) if len(sys.argv) > 3 else 487
+    training_size = n_trials // 2
+    spike_counts = synthetic_spike_counts(n_stim_patterns, n_trials, n_grc)
+    trials = np.tile(np.arange(n_trials), n_stim_patterns)
+    training = trials < training_size
+    tr_spike_counts = spike_counts[training]
+    ts_spike_counts = spike_counts[~training]
+    ts_stimuli = np.repeat(np.arange(n_stim_patterns), n_trials - training_size)
+    class_means = tr_spike_counts.reshape(n_stim_patterns, training_size, -1).mean(axis=1)
+    decoders = [('kmeans', KMeans(n_clusters=n_stim_patterns)),
+                ('minibatch_kmeans', MiniBatchKMeans(n_clusters=n_stim_patterns)),
+                ('warm_kmeans', KMeans(n_clusters=n_stim_patterns, init=class_means, n_init=1))]
+    print('{0} stimulus patterns, {1} trials ({2} for training), {3} cells. Maximum MI: {4:.3f} bits'.format(n_stim_patterns, n_trials, training_size, n_grc, np.log2(n_stim_patterns)))
+    for name, clustering in decoders:
+        start = time.time()
+        clustering.fit(tr_spike_counts)
+        decoded_output = clustering.predict(ts_spike_counts)
+        elapsed = time.time() - start
+        print('{0}: {1:.2f}s, decoded MI {2:.3f} bits'.format(name, elapsed, plugin_mi(ts_stimuli, decoded_output)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure how long many concurrent readers take to load the results
+from the same results archive, with the shared-lock read-only path
+used by ResultsArchive.load and with the exclusive-lock read-write
+path that was used for reading before.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_results_archive_locking [n_readers] [n_loads_per_reader]
+"""
+import sys
+import shutil
+import tempfile
+import time
+import multiprocessing
+import numpy as np
+
+from utils.archival import ResultsArchive
+
+class BenchmarkPoint(object):
+    """Stand-in for a ParameterSpacePoint, carrying only what
+    ResultsArchive needs."""
+    def __init__(self, data_folder_path):
+        self.data_folder_path = data_folder_path
+        self.n_stim_patterns = 1024
+        self.n_trials = 60
+        self.sim_duration = 180
+        self.ana_duration = 30
+        self.training_size = 30
+        self.multineuron_metric_mixing = 0.
+        self.linkage_method_string = 'ward'
+        self.tau = 5
+
+def read_results(job):
+    data_folder_path, n_loads, readonly = job
+    archive = ResultsArchive(BenchmarkPoint(data_folder_path))
+    for k in range(n_loads):
+        target_group = archive._open(readonly=readonly)
+        results = dict((ds, np.array(target_group[ds])) for ds in archive.datasets)
+        archive._close()
+    return len(results)
+
+def main():
+    n_readers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_loads = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    work_dir = tempfile.mkdtemp()
+    try:
+        archive = ResultsArchive(BenchmarkPoint(work_dir))
+        with archive.batch():
+            for ds in archive.datasets:
+                if ds.startswith('ts_decoded_mi'):
+                    archive.update_result(ds, data=np.random.uniform(size=1024))
+                else:
+                    archive.update_result(ds, data=np.random.uniform())
+        pool = multiprocessing.Pool(n_readers)
+        for readonly, description in [(False, 'exclusive lock'), (True, 'shared lock')]:
+            start = time.time()
+            pool.map(read_results, [(work_dir, n_loads, readonly)] * n_readers)
+            elapsed = time.time() - start
+            print('{0}: {1} readers x {2} loads in {3:.2f}s ({4:.0f} loads/s)'.format(description, n_readers, n_loads, elapsed, n_readers*n_loads/elapsed))
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
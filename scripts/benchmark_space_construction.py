@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the construction of the parameter spaces used by
+master_script.py and visualise.py, on synthetic network structures
+written to a temporary data folder. Network structures and spike
+archive paths are only looked up on first access, so the time needed
+to build the space is reported separately from the time needed to
+access those attributes on all points afterwards.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_space_construction
+"""
+import shutil
+import tempfile
+import time
+import os
+import random
+import networkx as nx
+
+from utils.pure import SimpleParameterSpacePoint
+from utils.parameters import ParameterSpace
+from utils.parameters import PSlice as psl
+
+def create_synthetic_network_structures(base_dir, n_mf=187, n_grc=487):
+    """Write a random bipartite graphml network structure for each
+    number of dendrites, with the same node numbering and attributes
+    as the real ones."""
+    for gd in range(1, 21):
+        graph = nx.Graph()
+        for node in range(1, n_mf+n_grc+1):
+            graph.add_node(node,
+                           bipartite=int(node > n_mf),
+                           x=random.uniform(0, 80),
+                           y=random.uniform(0, 80),
+                           z=random.uniform(0, 80))
+        for grc in range(n_mf+1, n_mf+n_grc+1):
+            for mf in random.sample(range(1, n_mf+1), gd):
+                graph.add_edge(mf, grc)
+        folder = '{0}/gd{1}/cr0'.format(base_dir, gd)
+        os.makedirs(folder)
+        nx.write_graphml(graph, '{0}/gd{1}_cr0.graphml'.format(folder, gd))
+
+def time_space(description, active_mf_fraction, n_trials, sim_duration):
+    start = time.time()
+    space = ParameterSpace(psl(1,21,1),
+                           psl(0),
+                           psl(0),
+                           active_mf_fraction,
+                           psl(1),
+                           psl(0.),
+                           psl(0.),
+                           psl(1.),
+                           psl(0),
+                           psl(80),
+                           psl(0),
+                           psl(10),
+                           psl(0),
+                           psl(1024),
+                           n_trials,
+                           sim_duration,
+                           psl(30.),
+                           psl(30),
+                           psl(0.),
+                           psl(1),
+                           psl(5),
+                           psl(2))
+    construction_time = time.time() - start
+    start = time.time()
+    for p in space.flat:
+        p.n_grc
+        p.spike_archive_path
+    access_time = time.time() - start
+    print('{0}: {1} points, construction {2:.3f}s, first access of network and spike archive attributes {3:.3f}s'.format(description, space.size, construction_time, access_time))
+
+def main():
+    base_dir = tempfile.mkdtemp()
+    original_base_dir = SimpleParameterSpacePoint.BASE_DIR
+    try:
+        create_synthetic_network_structures(base_dir)
+        SimpleParameterSpacePoint.BASE_DIR = base_dir
+        time_space('master_script.py', psl(.1,1.,.1), psl(1), psl(3750.))
+        time_space('visualise.py', psl(.05,1.,.05), psl(60), psl(180))
+    finally:
+        SimpleParameterSpacePoint.BASE_DIR = original_base_dir
+        shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    main()
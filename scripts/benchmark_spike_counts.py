@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the bulk spike counting engine in SpikesArchive with the
+original one-read-per-observation implementation, on a synthetic
+spike archive.
+
+Usage example (from the repository root):
+python -m scripts.benchmark_spike_counts [n_stim_patterns] [n_trials]
+"""
+import sys
+import os
+import shutil
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from utils.archival import SpikesArchive, create_chunked_spike_dataset
+
+class BenchmarkPoint(object):
+    """Stand-in for a ParameterSpacePoint, carrying only what
+    SpikesArchive needs."""
+    SIM_DECORRELATION_TIME = 30
+    def __init__(self, spike_archive_path, n_stim_patterns, n_trials, sim_duration, ana_duration):
+        self.spike_archive_path = spike_archive_path
+        self.n_stim_patterns = n_stim_patterns
+        self.n_trials = n_trials
+        self.sim_duration = sim_duration
+        self.ana_duration = ana_duration
+        self.sim_transient_time = sim_duration - ana_duration
+
+def create_synthetic_archive(path, n_stim_patterns, n_archive_trials, archive_sim_duration, n_mf=187, n_grc=487, rate=0.02):
+    """Write a spike archive with poisson-like spike times, padded with
+    -1 as in the archives produced by compress.py."""
+    archive = h5py.File(path, 'w')
+    archive.attrs['n_mf'] = n_mf
+    archive.attrs['n_grc'] = n_grc
+    archive.attrs['n_stim_patterns'] = n_stim_patterns
+    archive.attrs['n_trials'] = n_archive_trials
+    archive.attrs['sim_duration'] = archive_sim_duration
+    for spn in range(n_stim_patterns):
+        archive.create_group('{0:03d}'.format(spn))
+        archive['{0:03d}'.format(spn)].create_dataset('stim_pattern', data=np.sort(np.random.choice(n_mf, n_mf//2, replace=False)))
+        for trial in range(n_archive_trials):
+            group = archive.require_group('{0:03d}/{1:02d}'.format(spn, trial))
+            for cell_type, n_cells in [('mf', n_mf), ('grc', n_grc)]:
+                n_spikes = np.random.poisson(rate * archive_sim_duration, size=n_cells)
+                spikes = -np.ones((n_spikes.max(), n_cells), dtype=np.float32)
+                for cell, n in enumerate(n_spikes):
+                    spikes[:n, cell] = np.sort(np.random.uniform(0, archive_sim_duration, size=n))
+                create_chunked_spike_dataset(group, cell_type+'_spiketimes', spikes)
+    archive.close()
+
+def legacy_get_spike_counts(spikes_arch, cell_type='grc'):
+    """The original implementation of SpikesArchive.get_spike_counts,
+    with the slice numbering fixed to trial % slices_per_trial."""
+    point = spikes_arch.point
+    spikes_arch.load_attrs()
+    n_cells = spikes_arch.attrs['n_'+cell_type]
+    hdf5_handle = h5py.File(spikes_arch.path, 'r')
+    spike_counts = np.zeros((point.n_stim_patterns * point.n_trials, n_cells))
+    for spn in range(point.n_stim_patterns):
+        for trial in range(point.n_trials):
+            archive_trial = trial // spikes_arch.slices_per_trial
+            slice_number = trial % spikes_arch.slices_per_trial
+            slice_start = point.sim_transient_time + slice_number * (point.ana_duration + point.SIM_DECORRELATION_TIME)
+            slice_end = slice_start + point.ana_duration
+            spikes = np.array(hdf5_handle['/{0:03d}/{1:02d}/{2}_spiketimes'.format(spn, archive_trial, cell_type)])
+            if spikes.size:
+                spike_counts[spn*point.n_trials + trial] = np.sum(np.logical_and(spikes > slice_start, spikes < slice_end), axis=0)
+    hdf5_handle.close()
+    return spike_counts
+
+def main():
+    n_stim_patterns = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    sim_duration = 180.
+    ana_duration = 30.
+    # one long simulation per pattern, sliced in n_trials observations
+    archive_sim_duration = sim_duration + (n_trials - 1) * (ana_duration + BenchmarkPoint.SIM_DECORRELATION_TIME)
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, 'sp{0}_t1_sdur{1}.hdf5'.format(n_stim_patterns, int(archive_sim_duration)))
+        print('creating synthetic archive {0}'.format(path))
+        create_synthetic_archive(path, n_stim_patterns, 1, archive_sim_duration)
+        point = BenchmarkPoint(path, n_stim_patterns, n_trials, sim_duration, ana_duration)
+        spikes_arch = SpikesArchive(point)
+        for cell_type in ['mf', 'grc']:
+            start = time.time()
+            legacy_counts = legacy_get_spike_counts(spikes_arch, cell_type)
+            legacy_time = time.time() - start
+            start = time.time()
+            counts = spikes_arch.get_spike_counts(cell_type, use_cache=False)
+            bulk_time = time.time() - start
+            assert np.array_equal(counts, legacy_counts)
+            print('{0}: legacy {1:.3f}s, bulk {2:.3f}s, speedup {3:.1f}x'.format(cell_type, legacy_time, bulk_time, legacy_time/bulk_time))
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
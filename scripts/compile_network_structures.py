@@ -0,0 +1,33 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compile graphml network structures to the hdf5 format that is
+memory-mapped by utils/structures.py, so that the analysis code
+doesn't need to parse graphml at runtime. Each gdX_crY.graphml file
+is compiled to gdX_crY_structure.hdf5 in the same folder.
+
+Usage example (from the repository root):
+python -m scripts.compile_network_structures /path/to/data/gd*/cr*/gd*_cr*.graphml
+"""
+import sys
+import time
+import numpy as np
+
+from utils.structures import NetworkStructure, compiled_structure_path
+
+def compile_network_structure(graphml_path):
+    start = time.time()
+    structure = NetworkStructure.from_graphml(graphml_path)
+    graphml_time = time.time() - start
+    compiled_path = compiled_structure_path(graphml_path)
+    structure.save(compiled_path)
+    start = time.time()
+    compiled_structure = NetworkStructure.from_compiled(compiled_path)
+    compiled_time = time.time() - start
+    assert np.array_equal(compiled_structure.mf_positions, structure.mf_positions)
+    assert np.array_equal(compiled_structure.grc_positions, structure.grc_positions)
+    assert (compiled_structure.adjacency != structure.adjacency).nnz == 0
+    print('{0}: loading took {1:.3f}s from graphml, {2:.4f}s compiled'.format(compiled_path, graphml_time, compiled_time))
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        compile_network_structure(path)
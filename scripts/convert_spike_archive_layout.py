@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Convert spike archives from the dense layout (one padded
+(max_n_spikes, n_cells) dataset per trial) to the CSR layout now
+written by compress.py. The dense network adjacency matrix is
+replaced by the sparse MF->GrC one. Archives are converted in place;
+archives already in the CSR layout are left alone.
+
+Usage example (from the repository root):
+python -m scripts.convert_spike_archive_layout /path/to/sp1024_t1_sdur3750.hdf5 [...]
+"""
+import sys
+import os
+import h5py
+import numpy as np
+
+from utils.archival import create_csr_spike_datasets, append_csr_spikes, create_sparse_adjacency_datasets, read_sparse_adjacency
+
+def convert_archive(path):
+    source = h5py.File(path, 'r')
+    if source.attrs.get('spike_layout', 'dense') == 'csr':
+        print('{0} is already in CSR layout, skipping.'.format(path))
+        source.close()
+        return
+    temporary_path = path + '.tmp'
+    target = h5py.File(temporary_path, 'w')
+    for name, value in source.attrs.items():
+        target.attrs[name] = value
+    target.attrs['spike_layout'] = 'csr'
+    n_stim_patterns = int(source.attrs['n_stim_patterns'])
+    n_trials = int(source.attrs['n_trials'])
+    # cell positions, and network structure in sparse form
+    for name, item in source.items():
+        if isinstance(item, h5py.Dataset) and name != 'network_adjacency_matrix':
+            source.copy(name, target)
+    if 'network_adjacency_matrix' in source:
+        create_sparse_adjacency_datasets(target, read_sparse_adjacency(source))
+    for cell_type in ['mf', 'grc']:
+        create_csr_spike_datasets(target, cell_type, int(source.attrs['n_'+cell_type]))
+    for spn in range(n_stim_patterns):
+        pattern_group = '{0:03d}'.format(spn)
+        target.create_group(pattern_group)
+        source.copy('{0}/stim_pattern'.format(pattern_group), target[pattern_group])
+        for trial in range(n_trials):
+            for cell_type in ['mf', 'grc']:
+                spikes = source['/{0}/{1:02d}/{2}_spiketimes'.format(pattern_group, trial, cell_type)][...]
+                append_csr_spikes(target, cell_type, spikes)
+    target.close()
+    source.close()
+    old_size = os.path.getsize(path)
+    os.rename(temporary_path, path)
+    new_size = os.path.getsize(path)
+    print('{0}: {1:.1f}MB -> {2:.1f}MB'.format(path, old_size/1e6, new_size/1e6))
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        convert_archive(path)
@@ -12,4 +12,9 @@ do
     cp -v $origin_dir/GCLconnectivity_full_randomised.graphml $data_dir/gd$gd/cr1/gd"$gd"_cr1.graphml
 done
 
+# compile the network structures to the binary format used by the
+# analysis code, to avoid parsing graphml files at runtime.
+cd $(dirname $0)/..
+python -m scripts.compile_network_structures $data_dir/gd*/cr*/gd*_cr*.graphml
+
 exit 0
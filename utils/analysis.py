@@ -1,30 +1,114 @@
 import numpy as np
 import h5py
+import os.path
+import tempfile
 import random
-from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import linkage, fcluster, leaves_list
+from scipy.spatial.distance import pdist, squareform, cdist
 import functools
 from math import floor
+from multiprocessing.pool import ThreadPool
 
-def convolve(obs_array, sim_length, tau, dt):
-    """Convolve with exponential kernel."""
+def convolve(obs_array, sim_length, tau, dt, backend='binned', sample_times=None):
+    """Convolve with exponential kernel.
+
+    obs_array is a (n_obs, n_cells, max_n_spikes) array of spike
+    times. Negative or non-finite entries are treated as padding and
+    ignored. Two backends are available:
+
+    - 'binned' (default): spikes are binned with resolution dt, and
+      the kernel is sampled at dt and truncated at 10*tau. Return a
+      (n_obs, n_cells, n_bins) array, with n_bins=round(1.1*sim_length/dt).
+    - 'exact': the untruncated exponential kernel is evaluated
+      exactly, without binning the spikes, at the given sample_times
+      (by default, at the end of each of the bins above). Return a
+      (n_obs, n_cells, len(sample_times)) array.
+
+    See iter_convolve for a version with bounded memory usage.
+
+    """
+    obs_array = np.asarray(obs_array, dtype=float)
+    if backend == 'binned':
+        return _binned_convolution(obs_array, sim_length, tau, dt)
+    elif backend == 'exact':
+        if sample_times is None:
+            n_bins = int(round(1.1*sim_length/float(dt)))
+            sample_times = dt * np.arange(1, n_bins+1)
+        return exact_exponential_filter(obs_array, tau, sample_times)
+    else:
+        raise ValueError("Unknown convolution backend: {0}".format(backend))
+
+def _binned_convolution(obs_array, sim_length, tau, dt):
+    # All observations and cells are processed at once: every spike
+    # is mapped to the bins covered by its kernel, and the kernel
+    # values are accumulated in the output with a single weighted
+    # bincount.
     dt = float(dt)
     n_obs, n_cells, max_n_spikes = obs_array.shape
     kernel = np.exp(-np.arange(0, 10*tau, dt)/tau)
-    kernel_length = len(kernel)#10*tau/dt
+    kernel_length = len(kernel)
     n_bins = int(round(1.1*sim_length/dt))
-    conv = np.zeros(shape=(n_obs, n_cells, n_bins))
-
-    for o, obs in enumerate(obs_array):
-        for c, cell in enumerate(obs):
-            for spike_index in [int(floor(spike_time/dt)) for spike_time in cell]:
-                # here we could optimise this by writing it as a list comprehension, by using the .__add__ method
-                available_bins = n_bins - spike_index
-                if available_bins > kernel_length:
-                    conv[o, c, spike_index:spike_index+kernel_length] += kernel
-                else:
-                    conv[o, c, spike_index:] += kernel[:available_bins]
-    return conv
+    spike_bins = np.floor(obs_array.reshape(n_obs*n_cells, max_n_spikes)/dt)
+    spike_bins[~np.isfinite(spike_bins)] = -1
+    valid = np.logical_and(spike_bins >= 0, spike_bins < n_bins)
+    trains = np.nonzero(valid)[0]
+    spike_bins = spike_bins[valid].astype(np.intp)
+    # (n_spikes, kernel_length) arrays of target bins and kernel
+    # values. The kernel is truncated at the end of the time window.
+    target_bins = spike_bins[:,np.newaxis] + np.arange(kernel_length)
+    in_window = target_bins < n_bins
+    flat_bins = (trains[:,np.newaxis] * n_bins + target_bins)[in_window]
+    weights = np.tile(kernel, (spike_bins.size, 1))[in_window]
+    conv = np.bincount(flat_bins, weights=weights, minlength=n_obs*n_cells*n_bins)
+    return conv.astype(float, copy=False).reshape(n_obs, n_cells, n_bins)
+
+def exact_exponential_filter(obs_array, tau, sample_times):
+    """Evaluate the spike trains in obs_array (see convolve), filtered
+    with the causal kernel exp(-t/tau), at the given (increasing)
+    sample times.
+
+    Every spike contributes exp(-(t-s)/tau) to the first sample time
+    t following it. The traces are then computed with the first-order
+    recursion
+        f(t_j) = f(t_{j-1})*exp(-(t_j-t_{j-1})/tau) + contributions(t_j)
+    which runs over the samples, for all the spike trains at once. The
+    cost is independent of tau, and there is no binning or truncation
+    error.
+
+    """
+    sample_times = np.asarray(sample_times, dtype=float)
+    n_obs, n_cells, max_n_spikes = obs_array.shape
+    n_samples = sample_times.size
+    spike_times = obs_array.reshape(n_obs*n_cells, max_n_spikes)
+    valid = np.isfinite(spike_times)
+    valid[valid] = spike_times[valid] >= 0
+    trains = np.nonzero(valid)[0]
+    spike_times = spike_times[valid]
+    targets = np.searchsorted(sample_times, spike_times, side='left')
+    in_window = targets < n_samples
+    trains = trains[in_window]
+    targets = targets[in_window]
+    spike_times = spike_times[in_window]
+    # samples along the first axis, so that each step of the
+    # recursion works on contiguous memory.
+    traces = np.bincount(targets * (n_obs*n_cells) + trains,
+                         weights=np.exp(-(sample_times[targets] - spike_times)/tau),
+                         minlength=n_samples*n_obs*n_cells)
+    traces = traces.astype(float, copy=False).reshape(n_samples, n_obs*n_cells)
+    decay = np.exp(-np.diff(sample_times)/tau)
+    for j in range(1, n_samples):
+        traces[j] += traces[j-1] * decay[j-1]
+    return np.ascontiguousarray(traces.T).reshape(n_obs, n_cells, n_samples)
+
+def iter_convolve(obs_array, sim_length, tau, dt, block_size=100, **kwargs):
+    """Like convolve, but yield the convolved observations in blocks
+    of (at most) block_size observations, so that only one block needs
+    to be kept in memory at any time. obs_array can be anything that
+    supports slicing along its first axis, like an h5py
+    dataset. Additional keyword arguments are passed to convolve."""
+    n_obs = obs_array.shape[0]
+    for start in range(0, n_obs, block_size):
+        yield convolve(obs_array[start:start+block_size], sim_length, tau, dt, **kwargs)
 
 def multineuron_distance(p,q, theta):
     delta = p-q
@@ -34,6 +118,86 @@ def multineuron_distance_labeled_line(p,q):
     delta = p-q
     return np.sqrt(np.einsum('nt,nt', delta, delta))
 
+# vectors with at most this number of features have their pairwise
+# distances calculated directly by pairwise_distances, as the matrix
+# product doesn't pay off.
+EXACT_DISTANCES_MAX_FEATURES = 16
+# pairs of vectors whose squared distance is less than this fraction
+# of the sum of their squared norms are recalculated directly by
+# pairwise_distances.
+DISTANCE_REFINEMENT_TOLERANCE = 1e-6
+
+def pairwise_distances(vectors, memory_budget=2**28, out_path=None, exact=None):
+    """Matrix of the euclidean distances between all pairs of rows of
+    vectors (an (n_obs, ...) array, flattened to (n_obs, n_features)).
+
+    The distances are calculated in square blocks, and only the blocks
+    on or above the diagonal are calculated. Blocks are sized so that
+    the temporary arrays they need stay within memory_budget bytes. If
+    out_path is given, the (n_obs, n_obs) result is written to a
+    memory-mapped file at that path instead of being kept in memory.
+
+    If exact is True, every distance is calculated directly from the
+    differences between vectors, as by scipy's cdist. Otherwise, the
+    distances in a block are obtained with a single matrix product by
+    the identity |a-b|^2 = |a|^2 + |b|^2 - 2a.b. Rounding errors make
+    this inaccurate for vectors that are close compared to their
+    norms, so pairs whose distance is less than about 1e-3 times
+    their norms are recalculated directly (in particular, identical
+    vectors are always at distance 0). The relative error on the
+    other distances is of the order of 1e-8 at most. By default,
+    exact is True only for vectors with few features.
+
+    """
+    n_obs = vectors.shape[0]
+    vectors = np.asarray(vectors, dtype=float).reshape(n_obs, -1)
+    n_features = vectors.shape[1]
+    if exact is None:
+        exact = n_features <= EXACT_DISTANCES_MAX_FEATURES
+    squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+    # each block needs two (block_size, n_features) slices of vectors
+    # and about three (block_size, block_size) temporary arrays, so
+    # the largest block size is the positive root of
+    # 8*(3*b**2 + 2*n_features*b) = memory_budget
+    block_size = (-n_features + np.sqrt(n_features**2 + 3*memory_budget/8.)) / 3
+    block_size = int(max(1, min(n_obs, block_size)))
+    if out_path is None:
+        distances = np.zeros(shape=(n_obs, n_obs))
+    else:
+        distances = np.memmap(out_path, dtype=np.float64, mode='w+', shape=(n_obs, n_obs))
+    for row_start in range(0, n_obs, block_size):
+        rows = slice(row_start, min(row_start + block_size, n_obs))
+        for column_start in range(row_start, n_obs, block_size):
+            columns = slice(column_start, min(column_start + block_size, n_obs))
+            if exact:
+                block = cdist(vectors[rows], vectors[columns])
+            else:
+                block = _gram_distances(vectors, squared_norms, rows, columns, block_size)
+            distances[rows,columns] = block
+            distances[columns,rows] = block.T
+    distances[np.diag_indices(n_obs)] = 0
+    if out_path is not None:
+        distances.flush()
+    return distances
+
+def _gram_distances(vectors, squared_norms, rows, columns, max_pairs):
+    """Block of the distance matrix calculated by pairwise_distances
+    with a matrix product, with the distances between close vectors
+    recalculated directly, max_pairs pairs at a time."""
+    norm_sums = squared_norms[rows,np.newaxis] + squared_norms[np.newaxis,columns]
+    squared_distances = np.dot(vectors[rows], vectors[columns].T)
+    squared_distances *= -2
+    squared_distances += norm_sums
+    close_rows, close_columns = np.nonzero(squared_distances < DISTANCE_REFINEMENT_TOLERANCE * norm_sums)
+    for start in range(0, close_rows.size, max_pairs):
+        i = close_rows[start:start+max_pairs]
+        j = close_columns[start:start+max_pairs]
+        differences = vectors[rows.start + i] - vectors[columns.start + j]
+        squared_distances[i,j] = np.einsum('ij,ij->i', differences, differences)
+    # rounding errors can make small distances slightly negative
+    np.maximum(squared_distances, 0, out=squared_distances)
+    return np.sqrt(squared_distances, out=squared_distances)
+
 def output_level(spike_array):
     """if spike_array is a n_spiketrains*n_cells*max_spikes array, return the number of spikes per trial per cell."""
     o_level_array = (spike_array>0).sum(axis=2)
@@ -101,6 +265,102 @@ def cluster_centroids(min_mf_number, grc_mf_ratio, n_grc_dend, network_scale, ac
     close_archive(mi_archive, archive_lock)
     return clust_idxs, centroids, clust_sizes
 
+def maxclust_n_clusters(tree, n_clusts):
+    """Number of clusters actually formed by
+    fcluster(tree, t=n_clusts, criterion='maxclust') for a monotonic
+    linkage tree. This is less than n_clusts when the merge that
+    would be undone to get n_clusts clusters has the same height as
+    the next one."""
+    n = tree.shape[0] + 1
+    if n_clusts >= n:
+        return n
+    heights = tree[:,2]
+    return int(n - np.searchsorted(heights, heights[n-n_clusts-1], side='right'))
+
+def iter_linkage_medoids(tree, square_distances, max_n_clusters):
+    """Walk a monotonic linkage tree from the root down, undoing one
+    merge at a time. For n_clusters=1,...,max_n_clusters, yield the
+    medoids of the flat clustering with n_clusters clusters, as an
+    array of observation indexes. The medoid of a cluster is the
+    element that minimises the sum of the square distances from the
+    other elements of the cluster.
+
+    Clusters are contiguous in the leaf order of the tree. For each
+    cluster, the sums of square distances of its elements from the
+    rest of the cluster are cached. When a cluster splits, the sums
+    for its smaller child are computed directly, and those for the
+    larger child are obtained from the cached ones by subtracting the
+    distances from the smaller child. Only the cluster that split and
+    its medoid are updated at each step.
+
+    """
+    n = tree.shape[0] + 1
+    order = leaves_list(tree)
+    sizes = np.concatenate([np.ones(n, dtype=np.int64), tree[:,3].astype(np.int64)])
+    starts = np.zeros(2*n-1, dtype=np.int64)
+    for row in range(n-2, -1, -1):
+        left, right = int(tree[row,0]), int(tree[row,1])
+        starts[left] = starts[n+row]
+        starts[right] = starts[n+row] + sizes[left]
+    def members(node):
+        return order[starts[node]:starts[node]+sizes[node]]
+    root = 2*n-2
+    intracluster_sums = {root: square_distances.sum(axis=1)[order]}
+    medoids = {root: order[np.argmin(intracluster_sums[root])]}
+    yield np.array(sorted(medoids.values()))
+    for row in range(n-2, max(n-1-max_n_clusters, -1), -1):
+        node = n + row
+        left, right = int(tree[row,0]), int(tree[row,1])
+        parent_sums = intracluster_sums.pop(node)
+        del medoids[node]
+        n_left = sizes[left]
+        if sizes[left] <= sizes[right]:
+            small, large = left, right
+            large_parent_sums = parent_sums[n_left:]
+        else:
+            small, large = right, left
+            large_parent_sums = parent_sums[:n_left]
+        small_members = members(small)
+        large_members = members(large)
+        intracluster_sums[small] = square_distances[np.ix_(small_members, small_members)].sum(axis=1)
+        intracluster_sums[large] = large_parent_sums - square_distances[np.ix_(large_members, small_members)].sum(axis=1)
+        for child, child_members in [(small, small_members), (large, large_members)]:
+            medoids[child] = child_members[np.argmin(intracluster_sums[child])]
+        yield np.array(sorted(medoids.values()))
+
+def decode_nearest_medoid(distances, medoid_sets, memory_budget=2**28):
+    """Decode testing observations with several output alphabets at once.
+
+    distances is the (n_ts_obs, n_tr_obs) matrix of the distances
+    between testing and training observations, and medoid_sets a
+    sequence of arrays of training observation indexes, one for each
+    alphabet. Return a (len(medoid_sets), n_ts_obs) array where each
+    testing observation is decoded, for each alphabet, as the index
+    (within the alphabet) of the medoid it's closest to.
+
+    The medoid sets are padded to a common size and the relevant
+    distances gathered in a single (n_ts_obs, n_sets, max_set_size)
+    array, processed in blocks of testing observations sized to stay
+    within memory_budget bytes.
+
+    """
+    n_ts_obs = distances.shape[0]
+    n_sets = len(medoid_sets)
+    max_set_size = max([len(m) for m in medoid_sets] + [1])
+    padded_medoids = np.zeros(shape=(n_sets, max_set_size), dtype=np.intp)
+    padding = np.ones(shape=(n_sets, max_set_size), dtype=bool)
+    for k, medoids in enumerate(medoid_sets):
+        padded_medoids[k,:len(medoids)] = medoids
+        padding[k,:len(medoids)] = False
+    block_size = int(max(1, memory_budget // (8 * n_sets * max_set_size)))
+    decoded_output = np.zeros(shape=(n_sets, n_ts_obs), dtype=np.intp)
+    for start in range(0, n_ts_obs, block_size):
+        rows = slice(start, min(start + block_size, n_ts_obs))
+        medoid_distances = distances[rows][:,padded_medoids]
+        medoid_distances[:,padding] = np.inf
+        decoded_output[:,rows] = medoid_distances.argmin(axis=2).T
+    return decoded_output
+
 def kl_divergence(p,q):
     return (p * np.log2(p/q)).sum()
 
@@ -111,6 +371,113 @@ def kl_divergence_from_flat_p(q):
 def entropy(p):
     return -(p[p>0]*np.log2(p[p>0])).sum()
 
+def contingency_tables(decoded_outputs, n_output_symbols, n_obs_per_sp):
+    """Joint output/stimulus counts for a (n_sets, n_obs) stack of
+    decoded outputs (for instance, one row per cluster count), where
+    observations are ordered by stimulus pattern with n_obs_per_sp
+    observations for each pattern. The result has shape (n_sets,
+    n_output_symbols, n_stim_patterns)."""
+    decoded_outputs = np.atleast_2d(decoded_outputs)
+    n_sets, n_obs = decoded_outputs.shape
+    n_stim_patterns = n_obs // n_obs_per_sp
+    stimuli = np.repeat(np.arange(n_stim_patterns), n_obs_per_sp)
+    flat_idxs = (np.arange(n_sets)[:,np.newaxis] * n_output_symbols + decoded_outputs) * n_stim_patterns + stimuli
+    counts = np.bincount(flat_idxs.ravel(), minlength=n_sets*n_output_symbols*n_stim_patterns)
+    return counts.reshape(n_sets, n_output_symbols, n_stim_patterns)
+
+def _entropies(p):
+    """Entropy (in bits) of each of the distributions along the last
+    axis of p."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.where(p > 0, p * np.log2(p), 0).sum(axis=-1)
+
+def _distributions(tables):
+    """Output distribution, stimulus-conditional output distributions
+    and number of samples used to estimate each of them."""
+    tables = np.asarray(tables, dtype=float)
+    n_y = tables.sum(axis=1)
+    n = n_y.sum(axis=1)
+    p_x = tables.sum(axis=2) / n[:,np.newaxis]
+    p_x_given_y = tables.transpose(0,2,1) / n_y[:,:,np.newaxis]
+    return p_x, p_x_given_y, n, n_y
+
+def _pt_bayescount(p, n, dim):
+    """Bayesian estimate of the number of relevant bins of each of the
+    distributions along the last axis of p (Panzeri and Treves 1996),
+    as computed by pyentropy's pt_bayescount. n is the number of
+    samples used to estimate each distribution, and dim the number of
+    its possible values."""
+    n = np.asarray(n, dtype=float) * np.ones(p.shape[:-1])
+    dim = np.asarray(dim, dtype=float) * np.ones(p.shape[:-1])
+    occupied = p > np.finfo(float).eps
+    r_naive = occupied.sum(axis=-1).astype(float)
+    r_expected = r_naive - np.where(occupied, (1 - p)**n[...,np.newaxis], 0).sum(axis=-1)
+    delta_prev = dim.copy()
+    delta = np.abs(r_naive - r_expected)
+    # number of bins added to the naive count
+    xtr = np.zeros_like(r_naive)
+    searched = r_naive < dim
+    active = searched & (delta < delta_prev)
+    while active.any():
+        xtr[active] += 1
+        gamma = xtr * (1 - (n / (n + r_naive))**(1. / n))
+        # occupied bins
+        p_bayes = ((1 - gamma) / (n + r_naive))[...,np.newaxis] * (p * n[...,np.newaxis] + 1)
+        r_expected = np.where(occupied, 1 - (1 - p_bayes)**n[...,np.newaxis], 0).sum(axis=-1)
+        # non-occupied bins
+        p_bayes = gamma / np.maximum(xtr, 1)
+        r_expected += xtr * (1 - (1 - p_bayes)**n)
+        delta_prev = np.where(active, delta, delta_prev)
+        delta = np.where(active, np.abs(r_naive - r_expected), delta)
+        active &= (delta < delta_prev) & (r_naive + xtr < dim)
+    return np.where(searched, r_naive + xtr - 1 + (delta < delta_prev), r_naive)
+
+def plugin_mi(tables):
+    """Plugin estimate of the MI between stimulus and output for each of
+    a stack of contingency tables (see contingency_tables)."""
+    p_x, p_x_given_y, n, n_y = _distributions(tables)
+    h_x = _entropies(p_x)
+    h_x_given_y = (n_y / n[:,np.newaxis] * _entropies(p_x_given_y)).sum(axis=1)
+    return h_x - h_x_given_y
+
+def pt_mi(tables, n_output_symbols):
+    """Panzeri-Treves bias-corrected estimate of the MI between stimulus
+    and output for each of a stack of contingency tables (see
+    contingency_tables). n_output_symbols is the size of the output
+    alphabet for each table."""
+    p_x, p_x_given_y, n, n_y = _distributions(tables)
+    n_output_symbols = np.asarray(n_output_symbols, dtype=float) * np.ones(n.shape)
+    h_x = _entropies(p_x) + (_pt_bayescount(p_x, n, n_output_symbols) - 1) / (2 * n * np.log(2))
+    r_x_given_y = _pt_bayescount(p_x_given_y, n_y, n_output_symbols[:,np.newaxis])
+    h_x_given_y = _entropies(p_x_given_y) + (r_x_given_y - 1) / (2 * n_y * np.log(2))
+    return h_x - (n_y / n[:,np.newaxis] * h_x_given_y).sum(axis=1)
+
+def qe_mi(decoded_outputs, n_output_symbols, n_obs_per_sp, random_state=None):
+    """Quadratic extrapolation estimate of the MI between stimulus and
+    output for each row of a (n_sets, n_obs) stack of decoded outputs,
+    ordered as in contingency_tables. As in pyentropy's 'qe' method
+    with 'plugin' as the underlying estimator, the plugin estimate is
+    computed on the whole data, on halves and on quarters of the
+    trials for each stimulus pattern, and extrapolated to infinite
+    data size. The trials are split at random, using the given seed
+    for the random number generator. n_output_symbols only needs to be
+    as large as the largest output alphabet."""
+    decoded_outputs = np.atleast_2d(decoded_outputs)
+    n_sets, n_obs = decoded_outputs.shape
+    n_stim_patterns = n_obs // n_obs_per_sp
+    rng = np.random.RandomState(random_state)
+    # shuffle the trials within each stimulus pattern
+    trials = np.argsort(rng.uniform(size=(n_stim_patterns, n_obs_per_sp)), axis=1)
+    shuffled = decoded_outputs[:,(trials + n_obs_per_sp * np.arange(n_stim_patterns)[:,np.newaxis]).ravel()].reshape(n_sets, n_stim_patterns, n_obs_per_sp)
+    mi = []
+    for n_parts in [1, 2, 4]:
+        n_part_obs_per_sp = n_obs_per_sp // n_parts
+        # (n_parts*n_sets, n_stim_patterns*n_part_obs_per_sp) stack of subsampled outputs
+        parts = np.concatenate([shuffled[:,:,k*n_part_obs_per_sp:(k+1)*n_part_obs_per_sp].reshape(n_sets, -1) for k in range(n_parts)])
+        part_mi = plugin_mi(contingency_tables(parts, n_output_symbols, n_part_obs_per_sp))
+        mi.append(part_mi.reshape(n_parts, n_sets).mean(axis=0))
+    return (8 * mi[0] - 6 * mi[1] + mi[2]) / 3
+
 def output_sparsity(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials):
     out_spike_array = loadspikes(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, cell_type='grc')
     grc_act_prob = np.mean([(ob[:,0]>-1).sum()/float(ob.shape[0]) for ob in out_spike_array])
@@ -124,19 +491,52 @@ def output_level_array(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fracti
     return activity_level_out_array
 
 def synchrony(p):
-    """Population-wide average of Schreiber's (2003) bivariate correlation-based measure of spike-timing reliability. Meant to be used with already-filtered spike trains, so in this context they are probably going to be exponential- and not gaussian-filtered."""
-    n = p.shape[0]
-    sync = 0
-    for i, cell1 in enumerate(p):
-        for j, cell2 in enumerate(p[i:]):
-            sync += np.nan_to_num(np.correlate(cell1, cell2)/np.sqrt((np.square(cell1).sum() * np.square(cell2).sum())))
-    return (2/float(n*(n-1)))*sync
-
-def mean_synchrony(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, sim_duration, tau, dt):
+    """Population-wide average of Schreiber's (2003) bivariate correlation-based measure of spike-timing reliability. Meant to be used with already-filtered spike trains, so in this context they are probably going to be exponential- and not gaussian-filtered. p is a (n_cells, n_bins) array; see population_synchrony for the calculation."""
+    return population_synchrony(p[np.newaxis])[0]
+
+def population_synchrony(traces, n_threads=1, block_size=100):
+    """Synchrony measure (see synchrony) for each observation in a
+    (n_obs, n_cells, n_bins) array of filtered spike trains.
+
+    The measure is the sum of the zero-lag correlations c_ij between
+    the normalised traces of all the pairs of cells i<=j (the pairs
+    with i=j included, and with silent cells not contributing), scaled
+    by 2/(n_cells*(n_cells-1)). Since the sum of all the c_ij is the
+    squared norm of the sum of the normalised traces, no pair needs
+    to be considered explicitly: the cost is that of normalising the
+    traces. Observations are processed in blocks of block_size,
+    which are distributed over n_threads threads.
+
+    """
+    traces = np.asarray(traces, dtype=float)
+    n_obs, n_cells, n_bins = traces.shape
+    def block_synchrony(start):
+        block = traces[start:start+block_size]
+        norms = np.sqrt(np.einsum('ocb,ocb->oc', block, block))
+        active = norms > 0
+        normalised = block / np.where(active, norms, 1)[:,:,np.newaxis]
+        population_trace = normalised.sum(axis=1)
+        all_pairs = np.einsum('ob,ob->o', population_trace, population_trace)
+        # each active cell is perfectly correlated with itself
+        return (all_pairs + active.sum(axis=1)) / 2.
+    block_starts = range(0, n_obs, block_size)
+    if n_threads > 1:
+        pool = ThreadPool(n_threads)
+        sync = pool.map(block_synchrony, block_starts)
+        pool.close()
+        pool.join()
+    else:
+        sync = [block_synchrony(start) for start in block_starts]
+    return (2/float(n_cells*(n_cells-1))) * np.concatenate(sync + [np.zeros(0)])
+
+def mean_synchrony(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, sim_duration, tau, dt, n_samples=100, n_threads=1):
+    """Average synchrony across observations. If n_samples is None,
+    all the observations are used instead of a random sample."""
     out_spikes = loadspikes(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, cell_type='grc')
-    out_spikes = out_spikes[random.sample(range(out_spikes.shape[0]), 100)]
-    out_vectors = convolve(out_spikes, sim_duration, tau, dt)
-    return np.mean([synchrony(p) for p in out_vectors])
+    if n_samples is not None:
+        out_spikes = out_spikes[random.sample(range(out_spikes.shape[0]), n_samples)]
+    sync = [population_synchrony(out_vectors, n_threads=n_threads) for out_vectors in iter_convolve(out_spikes, sim_duration, tau, dt)]
+    return np.concatenate(sync).mean()
 
 def open_sync_archive(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials):
     filename = mi_archive_path_ctor(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma)
@@ -162,14 +562,21 @@ def analyse_synchrony(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fractio
     close_archive(archive, archive_lock)
     return synchrony
 
-def distance_matrix(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, sim_duration, tau, dt):
+def distance_matrix(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, sim_duration, tau, dt, memory_budget=2**28, out_path=None):
     out_spikes = loadspikes(grc_mf_ratio, n_grc_dend, network_scale, active_mf_fraction, bias, stim_rate_mu, stim_rate_sigma, noise_rate_mu, noise_rate_sigma, n_stim_patterns, n_trials, cell_type='grc')
-    out_vectors = convolve(out_spikes, sim_duration, tau, dt)
-    distances = []
-    for h, vec in enumerate(out_vectors):
-        for k in range(h+1, out_vectors.shape[0]):
-            distances.append(multineuron_distance_labeled_line(out_vectors[h], out_vectors[k]))
-    distances = squareform(np.array(distances))
+    n_obs, n_cells = out_spikes.shape[:2]
+    n_bins = int(round(1.1*sim_duration/float(dt)))
+    # the convolved observations are written block by block to a
+    # temporary memory-mapped file (next to out_path, if given), so
+    # that they never need to be all in memory at the same time.
+    block_size = int(max(1, memory_budget // (8 * n_cells * n_bins)))
+    temp_dir = os.path.dirname(os.path.abspath(out_path)) if out_path is not None else None
+    with tempfile.NamedTemporaryFile(dir=temp_dir, suffix='_vectors.dat') as vectors_file:
+        out_vectors = np.memmap(vectors_file.name, dtype=np.float64, mode='w+', shape=(n_obs, n_cells, n_bins))
+        for start, block in zip(range(0, n_obs, block_size), iter_convolve(out_spikes, sim_duration, tau, dt, block_size=block_size)):
+            out_vectors[start:start+block.shape[0]] = block
+        distances = pairwise_distances(out_vectors, memory_budget=memory_budget, out_path=out_path)
+        del out_vectors
     return distances
 
 
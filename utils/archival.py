@@ -1,18 +1,105 @@
+import io
+import time
+import contextlib
+import os.path
+import tarfile
 import numpy as np
 import h5py
 import fcntl
+from scipy import sparse
+
+# chunk size (in elements) for the resizable datasets of the CSR spike
+# archive layout. Both spike times (32-bit floats) and CSR pointers
+# (64-bit integers) give chunks within the 10kB-300kB range
+# recommended in the h5py documentation.
+CSR_CHUNK_SIZE = 32768
+# number of stimulus patterns whose spikes are read at once from a CSR
+# spike archive.
+CSR_READ_BLOCK_PATTERNS = 64
+
+class CompressionPolicy(object):
+    """Compression settings for the datasets written to spike and
+    results archives.
+
+    codec can be 'gzip' (with the given level, from 0 to 9) or
+    'lzf'. If shuffle is True, the HDF5 shuffle filter is applied
+    before compression. If delta is True, the spike times of CSR spike
+    archives are stored as differences between consecutive spikes in
+    the same train, counted in integer multiples of resolution (in
+    ms). This loses any precision below the resolution, and has no
+    effect on other datasets.
+
+    """
+    def __init__(self, codec='gzip', level=4, shuffle=False, delta=False, resolution=0.001):
+        if codec not in ('gzip', 'lzf'):
+            raise ValueError('Unknown compression codec: {0}'.format(codec))
+        self.codec = codec
+        self.level = level
+        self.shuffle = shuffle
+        self.delta = delta
+        self.resolution = resolution
+    def __repr__(self):
+        return "CompressionPolicy(codec='{0}', level={1}, shuffle={2}, delta={3}, resolution={4})".format(self.codec, self.level, self.shuffle, self.delta, self.resolution)
+    def dataset_options(self):
+        """Keyword arguments for h5py's create_dataset."""
+        options = {'compression': self.codec,
+                   'shuffle': self.shuffle}
+        if self.codec == 'gzip':
+            options['compression_opts'] = self.level
+        return options
 
 class SpikesArchive(object):
+    # compression settings for the spike datasets written by
+    # compress.py and for the spike counts cache
+    compression = CompressionPolicy(codec='gzip', level=4, shuffle=True)
     def __init__(self, point):
         self.point = point
-        self.path = self.point.spike_archive_path
+        self._path = None
+        self.counts_cache = SpikeCountsCache(self)
+    @property
+    def path(self):
+        # unless set explicitly (as done by compress.py while writing
+        # the archive), this is the spike archive path of the point,
+        # which is only looked up on first access.
+        if self._path is None:
+            return self.point.spike_archive_path
+        return self._path
+    @path.setter
+    def path(self, path):
+        self._path = path
     def open_hdf5_handle(self):
         return h5py.File(self.path)
     def load_attrs(self):
         with h5py.File(self.path) as hdf5_handle:
             self.attrs = dict(hdf5_handle.attrs)
+        # archives written before the introduction of the CSR layout
+        # don't declare their layout.
+        self.layout = self.attrs.get('spike_layout', 'dense')
         self.slices_per_trial = int(1 + (self.attrs['sim_duration'] - self.point.sim_duration)//(self.point.ana_duration + self.point.SIM_DECORRELATION_TIME))
+        self.slice_starts = self.point.sim_transient_time + np.arange(self.slices_per_trial) * (self.point.ana_duration + self.point.SIM_DECORRELATION_TIME)
     def get_spikes(self, cell_type='grc'):
+        """
+        Get a list of n_stim_patterns*n_trials observations, each of
+        them being a list of n_cells spike trains (lists of spike
+        times). Only the spikes t such that
+        (sim_duration-ana_duration) < t < sim_duration
+        are considered. Spikes coming from a later slice of a longer
+        archive trial are shifted back in time, so that all
+        observations cover the same time window.
+
+        """
+        times, indptr = self.get_spike_trains(cell_type)
+        n_cells = self.attrs['n_'+cell_type]
+        n_obs = self.point.n_stim_patterns * self.point.n_trials
+        return [[times[indptr[o*n_cells+c]:indptr[o*n_cells+c+1]].tolist() for c in range(n_cells)] for o in range(n_obs)]
+    def get_spike_trains(self, cell_type='grc'):
+        """
+        Same as get_spikes, but return the spike trains in CSR form:
+        a (times, indptr) pair of arrays such that the spike train of
+        cell c in observation o is
+        times[indptr[o*n_cells+c]:indptr[o*n_cells+c+1]]
+
+        """
         # no need to lock the archive or to save the file handle,
         # since we plan on using this in read-only mode.  TODO: this
         # actually needs to be revised, since ultimately we would like
@@ -20,38 +107,122 @@ class SpikesArchive(object):
         # script, which means write-access as well. 
         self.load_attrs()
         n_cells = self.attrs['n_'+cell_type]
-        start_time = self.point.sim_duration - self.point.ana_duration
+        n_obs = self.point.n_stim_patterns * self.point.n_trials
+        all_keys = []
+        all_times = []
         hdf5_handle = self.open_hdf5_handle()
-        observation_list = [np.array(hdf5_handle['/{0:03d}/{1:02d}/{2}_spiketimes'.format(spn, tn, cell_type)]) for spn in range(self.point.n_stim_patterns) for tn in range(self.point.n_trials)]
+        for spns, archive_trials, cells, times in self._iter_spike_blocks(hdf5_handle, cell_type):
+            rows, in_window, slice_idxs = self._observation_rows(spns, archive_trials, times)
+            if not in_window.any():
+                continue
+            all_keys.append((rows * n_cells + cells)[in_window])
+            all_times.append(times[in_window] - self.slice_starts[slice_idxs[in_window]] + self.point.sim_transient_time)
         hdf5_handle.close()
-        spikes = [[c[c>start_time].tolist() for c in o.transpose()] for o in observation_list]
-        return spikes
-    def get_spike_counts(self, cell_type='grc'):
+        keys = np.concatenate(all_keys + [np.zeros(0, dtype=np.int64)])
+        times = np.concatenate(all_times + [np.zeros(0)])
+        # group spikes by observation and cell. The sort is stable,
+        # so every spike train stays ordered in time.
+        order = np.argsort(keys, kind='mergesort')
+        indptr = np.zeros(n_obs*n_cells+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(keys, minlength=n_obs*n_cells))
+        return times[order].astype(np.float64), indptr
+    def get_spike_counts(self, cell_type='grc', use_cache=True):
         """
         Get (n_stim_patterns*n_trials, n_cells)-sized array of spike
         counts for the given cell type, calculated considering only
         the spikes t such that
         (sim_duration-ana_duration) < t < sim_duration
 
+        Unless use_cache is False, the counts are looked up in (and
+        saved to) the spike counts cache stored next to the archive.
+
         """
+        if use_cache:
+            spike_counts = self.counts_cache.load(cell_type)
+            if spike_counts is not None:
+                return spike_counts
+        spike_counts = self._count_spikes(cell_type)
+        if use_cache:
+            self.counts_cache.store(cell_type, spike_counts)
+        return spike_counts
+    def _count_spikes(self, cell_type):
         self.load_attrs()
         n_cells = self.attrs['n_'+cell_type]
-        start_time = self.point.sim_duration - self.point.ana_duration
+        n_obs = self.point.n_stim_patterns * self.point.n_trials
+        # collect the (observation, cell) keys of the spikes in all
+        # blocks, and count them in a single pass at the end.
+        all_keys = []
         hdf5_handle = self.open_hdf5_handle()
-        spike_counts = np.zeros((self.point.n_stim_patterns * self.point.n_trials, n_cells))
-        for spn in range(self.point.n_stim_patterns):
-            for trial in range(self.point.n_trials):
-                archive_trial = trial // self.slices_per_trial
-                slice_number = trial - archive_trial
-                slice_start = self.point.sim_transient_time + slice_number * (self.point.ana_duration + self.point.SIM_DECORRELATION_TIME)
-                slice_end = slice_start + self.point.ana_duration
-                spikes = np.array(hdf5_handle['/{0:03d}/{1:02d}/{2}_spiketimes'.format(spn, archive_trial, cell_type)])
-                if spikes.size:
-                    # that is, if the network was not completely silent in this observation
-                    spike_counts[spn*self.point.n_trials + trial] = np.sum(np.logical_and(spikes > slice_start, spikes < slice_end), axis=0)
+        for spns, archive_trials, cells, times in self._iter_spike_blocks(hdf5_handle, cell_type):
+            rows, in_window, slice_idxs = self._observation_rows(spns, archive_trials, times)
+            all_keys.append((rows * n_cells + cells)[in_window])
         hdf5_handle.close()
-        return spike_counts
+        keys = np.concatenate(all_keys + [np.zeros(0, dtype=np.int64)])
+        spike_counts = np.bincount(keys, minlength=n_obs*n_cells).astype(float)
+        return spike_counts.reshape(n_obs, n_cells)
+    def _iter_spike_blocks(self, hdf5_handle, cell_type):
+        """
+        Iterate over the spikes of the given cell type stored in the
+        archive trials needed by the point. Every block is a
+        (stim_pattern_numbers, archive_trials, cells, times) tuple of
+        arrays with one element per spike, or of scalars when a value
+        is shared by all spikes in the block. Call load_attrs first.
+
+        """
+        n_cells = self.attrs['n_'+cell_type]
+        n_stim_patterns = self.point.n_stim_patterns
+        # number of trials in the archive that get sliced to provide
+        # the point's trials
+        n_archive_trials = int(np.ceil(self.point.n_trials / float(self.slices_per_trial)))
+        if self.layout == 'csr':
+            # with the CSR layout all the spikes of a block of stimulus
+            # patterns are read in two contiguous reads.
+            group = hdf5_handle['spikes/{0}'.format(cell_type)]
+            archive_n_trials = int(self.attrs['n_trials'])
+            for first_spn in range(0, n_stim_patterns, CSR_READ_BLOCK_PATTERNS):
+                last_spn = min(first_spn + CSR_READ_BLOCK_PATTERNS, n_stim_patterns)
+                first_train = first_spn * archive_n_trials * n_cells
+                last_train = ((last_spn - 1) * archive_n_trials + n_archive_trials) * n_cells
+                times, indptr = read_csr_trains(group, first_train, last_train)
+                trains = np.repeat(np.arange(first_train, last_train), np.diff(indptr))
+                observations, cells = np.divmod(trains, n_cells)
+                spns, archive_trials = np.divmod(observations, archive_n_trials)
+                yield spns, archive_trials, cells, times
+        else:
+            # the dense layout has one (max_n_spikes, n_cells) dataset
+            # per archive trial, padded with non-positive values.
+            for spn in range(n_stim_patterns):
+                for archive_trial in range(n_archive_trials):
+                    spikes = hdf5_handle['/{0:03d}/{1:02d}/{2}_spiketimes'.format(spn, archive_trial, cell_type)][...]
+                    if spikes.size:
+                        # that is, if the network was not completely silent in this archive trial
+                        cells = np.tile(np.arange(n_cells), spikes.shape[0])
+                        yield spn, archive_trial, cells, spikes.ravel()
+    def _observation_rows(self, spns, archive_trials, times):
+        """
+        Map spikes to the observations (rows of the spike count
+        matrix) they belong to. Return the row indexes, a boolean mask
+        selecting the spikes that fall within an analysis window of
+        one of the point's trials, and the index of the slice each
+        spike belongs to within its archive trial (-1 if none).
+
+        """
+        slice_idxs = slice_spike_times(times, self.slice_starts, self.point.ana_duration)
+        trials = archive_trials * self.slices_per_trial + slice_idxs
+        in_window = np.logical_and(slice_idxs >= 0, trials < self.point.n_trials)
+        rows = spns * self.point.n_trials + trials
+        return rows, in_window, slice_idxs
+
+    def get_network_adjacency(self):
+        """
+        Get the MF->GrC adjacency matrix of the network as a
+        (n_mf, n_grc) scipy.sparse CSR matrix.
 
+        """
+        hdf5_handle = self.open_hdf5_handle()
+        adjacency = read_sparse_adjacency(hdf5_handle)
+        hdf5_handle.close()
+        return adjacency
     def get_stim_pattern(self, stim_pattern_number):
         self.load_attrs()
         hdf5_handle = self.open_hdf5_handle()
@@ -59,62 +230,261 @@ class SpikesArchive(object):
         hdf5_handle.close()
         return pattern
   
+class SharedSpikeData(object):
+    """Spike data read from a spike archive and kept in memory, so that
+    it can be shared by all the points that analyse the same window
+    of the same archive (see ParameterSpace.analysis_groups). This
+    offers the part of the SpikesArchive interface used by
+    ParameterSpacePoint.run_analysis, and every array is read from
+    the archive only once. The arrays are shared, and are therefore
+    read-only.
+
+    """
+    def __init__(self, spikes_arch):
+        self.spikes_arch = spikes_arch
+        self._spike_counts = {}
+        self._spike_trains = {}
+    @property
+    def attrs(self):
+        if not hasattr(self.spikes_arch, 'attrs'):
+            self.spikes_arch.load_attrs()
+        return self.spikes_arch.attrs
+    def get_spike_counts(self, cell_type='grc'):
+        if cell_type not in self._spike_counts:
+            spike_counts = self.spikes_arch.get_spike_counts(cell_type=cell_type)
+            spike_counts.setflags(write=False)
+            self._spike_counts[cell_type] = spike_counts
+        return self._spike_counts[cell_type]
+    def get_spike_trains(self, cell_type='grc'):
+        if cell_type not in self._spike_trains:
+            times, indptr = self.spikes_arch.get_spike_trains(cell_type=cell_type)
+            times.setflags(write=False)
+            indptr.setflags(write=False)
+            self._spike_trains[cell_type] = times, indptr
+        return self._spike_trains[cell_type]
+
+class SpikeCountsCache(object):
+    """Spike counts computed from a spike archive, stored in a sidecar
+    hdf5 file next to it.
+
+    Counts are grouped by the analysis window they were computed for,
+    as specified by (sim_duration, ana_duration, n_stim_patterns,
+    n_trials, SIM_DECORRELATION_TIME). The modification time and size
+    of the spike archive are recorded in the sidecar. Cached counts
+    are ignored when they don't match the archive on disk anymore,
+    and the whole cache is recreated by the next write.
+
+    """
+    def __init__(self, spikes_arch):
+        self.spikes_arch = spikes_arch
+    @property
+    def path(self):
+        # the name must not match the 'sp*_t*_sdur*.hdf5' pattern used
+        # to look for spike archives.
+        return self.spikes_arch.path.rpartition('.hdf5')[0] + '_counts.h5'
+    def _archive_signature(self):
+        return os.path.getmtime(self.spikes_arch.path), os.path.getsize(self.spikes_arch.path)
+    def _group_name(self):
+        point = self.spikes_arch.point
+        return 'sp{0}/t{1}/sdur{2}/adur{3}/dec{4}'.format(point.n_stim_patterns,
+                                                         point.n_trials,
+                                                         int(point.sim_duration),
+                                                         int(point.ana_duration),
+                                                         int(point.SIM_DECORRELATION_TIME))
+    def _is_current(self):
+        mtime, size = self._archive_signature()
+        return (self._hdf5_handle.attrs.get('archive_mtime') == mtime and
+                self._hdf5_handle.attrs.get('archive_size') == size)
+    def _open(self, readonly=False):
+        # readers share the lock among themselves, and only wait for
+        # writers. In read-only mode the cache must exist, and None is
+        # returned if it doesn't hold counts for the current spike
+        # archive. Writers start a new cache in that case.
+        self._hdf5_handle = None
+        if readonly:
+            self._lock = open(self.path, 'r')
+            fcntl.lockf(self._lock, fcntl.LOCK_SH)
+        else:
+            self._lock = open(self.path, 'a')
+            fcntl.lockf(self._lock, fcntl.LOCK_EX)
+        try:
+            is_empty = os.fstat(self._lock.fileno()).st_size == 0
+            if readonly:
+                if is_empty:
+                    # a writer was interrupted before creating the cache
+                    return None
+                self._hdf5_handle = h5py.File(self.path, 'r')
+                if not self._is_current():
+                    return None
+                return self._hdf5_handle.get(self._group_name())
+            if not is_empty:
+                try:
+                    self._hdf5_handle = h5py.File(self.path, 'r+')
+                except IOError:
+                    # not a valid hdf5 file: start a new cache
+                    self._hdf5_handle = None
+            if self._hdf5_handle is None or not self._is_current():
+                # the spike archive has changed since the counts were
+                # cached (or nothing was cached yet): forget about
+                # them.
+                if self._hdf5_handle is not None:
+                    self._hdf5_handle.close()
+                self._hdf5_handle = h5py.File(self.path, 'w')
+                mtime, size = self._archive_signature()
+                self._hdf5_handle.attrs['archive_mtime'] = mtime
+                self._hdf5_handle.attrs['archive_size'] = size
+            return self._hdf5_handle.require_group(self._group_name())
+        except Exception:
+            # don't leave the cache locked if it can't be opened
+            self._close()
+            raise
+    def _close(self):
+        if self._hdf5_handle is not None:
+            self._hdf5_handle.close()
+        fcntl.lockf(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+    def load(self, cell_type):
+        """Return the cached spike counts for the given cell type, or None
+        if they are not available."""
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            target_group = self._open(readonly=True)
+        except (IOError, OSError):
+            return None
+        try:
+            if target_group is not None and cell_type in target_group:
+                return np.array(target_group[cell_type])
+            else:
+                return None
+        finally:
+            self._close()
+    def store(self, cell_type, spike_counts):
+        try:
+            target_group = self._open()
+        except (IOError, OSError) as e:
+            # not being able to cache the counts (for instance if the
+            # data folder is read-only) is not a reason to fail.
+            print("Warning: can't cache spike counts in {0}. Error was: {1}".format(self.path, e))
+            return
+        try:
+            if cell_type in target_group:
+                del target_group[cell_type]
+            target_group.create_dataset(cell_type,
+                                        data=spike_counts,
+                                        **self.spikes_arch.compression.dataset_options())
+        finally:
+            self._close()
+
 class ResultsArchive(object):
+    # compression settings for non-scalar results
+    compression = CompressionPolicy(codec='gzip', level=4)
+    datasets = ['ts_decoded_mi_plugin',
+                'ts_decoded_mi_qe',
+                'ts_decoded_mi_pt',
+                'ts_decoded_mi_nsb',
+                'i_mean_count',
+                'o_mean_count',
+                'i_sparseness_hoyer',
+                'i_sparseness_activity',
+                'i_sparseness_vinje',
+                'o_sparseness_hoyer',
+                'o_sparseness_activity',
+                'o_sparseness_vinje']
+    # attribute of the point's group recording the time of the last
+    # write to the group
+    stamp_attribute = 'results_stamp'
     def __init__(self, point):
         self.point = point
         self.path = "{0}/mi.hdf5".format(self.point.data_folder_path)
-        self.datasets = ['ts_decoded_mi_plugin',
-                         'ts_decoded_mi_qe',
-                         'ts_decoded_mi_pt',
-                         'ts_decoded_mi_nsb',
-                         'i_mean_count',
-                         'o_mean_count',
-                         'i_sparseness_hoyer',
-                         'i_sparseness_activity',
-                         'i_sparseness_vinje',
-                         'o_sparseness_hoyer',
-                         'o_sparseness_activity',
-                         'o_sparseness_vinje']
+        # target group of the archive while a batch of results is
+        # being written (see the batch method)
+        self._batch_group = None
+        self._batch_results = None
     def _is_archive_on_disk_complete(self):
-        target_group = self._open()
-        answer = all([ds in target_group.keys() for ds in self.datasets])
+        if not os.path.isfile(self.path):
+            return False
+        target_group = self._open(readonly=True)
+        answer = target_group is not None and all([ds in target_group.keys() for ds in self.datasets])
         self._close()
         return answer
     def _has_been_loaded(self):
         return all([hasattr(self.point, ds) for ds in self.datasets])
-    def _open(self):
+    def _group_names(self):
+        return ['sp%d' % self.point.n_stim_patterns,
+                't%d' % self.point.n_trials,
+                'sdur%d' % self.point.sim_duration,
+                'adur%d' % self.point.ana_duration,
+                'train%d' % self.point.training_size,
+                'mix%.2f' % self.point.multineuron_metric_mixing,
+                'method_%s' % self.point.linkage_method_string,
+                'tau%d' % self.point.tau]
+    def _open(self, readonly=False):
         # we need to create and remember a file handle and a file lock for the archive,
         #   to avoid concurrent writes by other analysis processes.
+        #   Readers share the lock among themselves, and only wait for
+        #   writers. In read-only mode the archive must exist, and
+        #   None is returned if the target group is missing.
+        if readonly:
+            self._lock = open(self.path, 'r')
+            fcntl.lockf(self._lock, fcntl.LOCK_SH)
+            if os.fstat(self._lock.fileno()).st_size == 0:
+                # a writer was interrupted before creating the archive
+                self._hdf5_handle = None
+                return None
+            self._hdf5_handle = h5py.File(self.path, 'r')
+            return self._hdf5_handle.get('/'.join(self._group_names()))
         self._lock = open(self.path, 'a')
         fcntl.lockf(self._lock, fcntl.LOCK_EX)
         self._hdf5_handle = h5py.File(self.path)
-        nspg = self._hdf5_handle.require_group('sp%d' % self.point.n_stim_patterns)
-        ntrg = nspg.require_group('t%d' % self.point.n_trials)
-        sdurg = ntrg.require_group('sdur%d' % self.point.sim_duration)
-        adurg = sdurg.require_group('adur%d' % self.point.ana_duration)
-        trsg = adurg.require_group('train%d' % self.point.training_size)
-        mixg = trsg.require_group('mix%.2f' % self.point.multineuron_metric_mixing)
-        clmg = mixg.require_group('method_%s' % self.point.linkage_method_string)
-        target_group = clmg.require_group('tau%d' % self.point.tau)
+        target_group = self._hdf5_handle
+        for name in self._group_names():
+            target_group = target_group.require_group(name)
         return target_group
     def _close(self):
-        self._hdf5_handle.close()
+        if self._hdf5_handle is not None:
+            self._hdf5_handle.close()
         fcntl.lockf(self._lock, fcntl.LOCK_UN)
-    def _load_from_disk(self):
-        if self._is_archive_on_disk_complete():
-            # the analysis results we're looking for are in the corresponding hdf5 archive on disk
-            target_group = self._open()
-            for ds in self.datasets:
-                setattr(self.point, ds, np.array(target_group[ds]))
-            self._close()
+        self._lock.close()
+    def _set_point_attributes(self, results):
+        """Store the given results (a name->data dictionary) as attributes
+        of the point."""
+        for ds in self.datasets:
+            if ds in results:
+                setattr(self.point, ds, np.array(results[ds]))
+        if self._has_been_loaded():
             self.point.point_mi_plugin = self.point.ts_decoded_mi_plugin[self.point.n_stim_patterns-1]
             self.point.point_mi_qe = self.point.ts_decoded_mi_qe[self.point.n_stim_patterns-1]
             self.point.point_mi_pt = self.point.ts_decoded_mi_pt[self.point.n_stim_patterns-1]
             self.point.point_mi_nsb = self.point.ts_decoded_mi_nsb[self.point.n_stim_patterns-1]
-            return True
+    def _load_from_disk(self):
+        # check for completeness and read in a single open of the archive
+        if not os.path.isfile(self.path):
+            return False
+        target_group = self._open(readonly=True)
+        if target_group is not None and all([ds in target_group.keys() for ds in self.datasets]):
+            # the analysis results we're looking for are in the corresponding hdf5 archive on disk
+            results = dict((ds, np.array(target_group[ds])) for ds in self.datasets)
         else:
             # the hdf5 archive seems to be incomplete or missing
+            results = None
+        self._close()
+        if results is None:
             return False
+        self._set_point_attributes(results)
+        return True
+    def load_result(self, result_name):
+        """Read a single result from the archive on disk. Return None
+        if the result is not in the archive."""
+        if not os.path.isfile(self.path):
+            return None
+        target_group = self._open(readonly=True)
+        if target_group is not None and result_name in target_group:
+            data = np.array(target_group[result_name])
+        else:
+            data = None
+        self._close()
+        return data
     def load(self):
         if self._has_been_loaded():
             # the results have been stored already in the corresponding Point object.
@@ -122,8 +492,69 @@ class ResultsArchive(object):
         else:
             # we need to load them from the hdf5 archive, if it exists
             return self._load_from_disk()
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager to write several results while locking and
+        opening the archive only once. Inside the 'with' block,
+        update_result writes to the already open archive. When the
+        block completes successfully, the written results are also
+        stored as attributes of the point, as if they had been loaded
+        from the archive.
+
+        Usage:
+        with point.results_arch.batch():
+            point.results_arch.update_result('i_mean_count', data=i_mean_count)
+            point.results_arch.update_result('o_mean_count', data=o_mean_count)
+
+        """
+        self._batch_group = self._open()
+        self._batch_results = {}
+        try:
+            yield self
+        finally:
+            self._close()
+            results = self._batch_results
+            self._batch_group = None
+            self._batch_results = None
+        self._set_point_attributes(results)
     def update_result(self, result_name, data):
-        target_group = self._open()
+        if self._batch_group is not None:
+            self._write_result(self._batch_group, result_name, data)
+            self._batch_results[result_name] = data
+        else:
+            target_group = self._open()
+            self._write_result(target_group, result_name, data)
+            self._close()
+    @classmethod
+    def read_results_stamps(cls, archives):
+        """Read the results stamp (see _write_result) of each of the
+        given ResultsArchives, opening every archive file only
+        once. The stamp is nan for results that are not on disk."""
+        stamps = [np.nan] * len(archives)
+        archives_by_path = {}
+        for n, archive in enumerate(archives):
+            archives_by_path.setdefault(archive.path, []).append(n)
+        for path, idxs in archives_by_path.items():
+            if not os.path.isfile(path):
+                continue
+            lock = open(path, 'r')
+            fcntl.lockf(lock, fcntl.LOCK_SH)
+            try:
+                if os.fstat(lock.fileno()).st_size > 0:
+                    with h5py.File(path, 'r') as hdf5_handle:
+                        for n in idxs:
+                            group = hdf5_handle.get('/'.join(archives[n]._group_names()))
+                            if group is not None:
+                                stamps[n] = group.attrs.get(cls.stamp_attribute, np.nan)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+                lock.close()
+        return stamps
+    def _write_result(self, target_group, result_name, data):
+        # the archive file is shared by all the points that differ
+        # only in analysis coordinates, so changes to the results of
+        # a point are tracked on its own group.
+        target_group.attrs[self.stamp_attribute] = time.time()
         if result_name in target_group.keys():
             del target_group[result_name]
         if np.isscalar(data):
@@ -136,11 +567,159 @@ class ResultsArchive(object):
             # one-dimensional.
             target_group.create_dataset(result_name,
                                         data=data,
-                                        compression='gzip',
-                                        compression_opts=9)
-        self._close()
+                                        **self.compression.dataset_options())
+
+class ResultsIndex(object):
+    """Columnar summary of the analysis results of all the points
+    analysed under a data folder, kept in a single hdf5 file so that
+    the results of a whole parameter space can be loaded in one read
+    instead of opening every point's mi.hdf5 archive.
+
+    The file contains one row per ParameterSpacePoint, identified by
+    the point's repr in the 'point' column, and one column for each of
+    the ResultsArchive.datasets. Array-valued results are stored as
+    variable-length rows. The mi.hdf5 archives remain the reference
+    copy of the results: the index can always be rebuilt from them
+    (see ParameterSpace.update_results_index). The results stamp of
+    the archive group each row was read from is stored with the row,
+    so that rows can be recognised as stale when the results of the
+    point have been written again since (see stale_points).
+
+    """
+    def __init__(self, base_dir):
+        self.path = "{0}/results_index.hdf5".format(base_dir)
+        self.datasets = ResultsArchive.datasets
+    signature_columns = [ResultsArchive.stamp_attribute]
+    def _open(self, readonly=False):
+        # same locking scheme as ResultsArchive._open. In read-only
+        # mode None is returned if the index is empty.
+        if readonly:
+            self._lock = open(self.path, 'r')
+            fcntl.lockf(self._lock, fcntl.LOCK_SH)
+            if os.fstat(self._lock.fileno()).st_size == 0:
+                # a writer was interrupted before creating the index
+                self._hdf5_handle = None
+                return None
+            self._hdf5_handle = h5py.File(self.path, 'r')
+        else:
+            self._lock = open(self.path, 'a')
+            fcntl.lockf(self._lock, fcntl.LOCK_EX)
+            self._hdf5_handle = h5py.File(self.path)
+        return self._hdf5_handle
+    def _close(self):
+        if self._hdf5_handle is not None:
+            self._hdf5_handle.close()
+        fcntl.lockf(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+    @classmethod
+    def is_stale(cls, results, stamp):
+        """Tell whether a row of results read from the index (see load)
+        doesn't match the results of the point as last written to
+        its archive, as given by their results stamp. Rows that
+        predate the recording of stamps are always stale."""
+        return results.get(ResultsArchive.stamp_attribute, np.nan) != stamp
+    def stale_points(self, points, indexed_results):
+        """Return the points, among the given ones, whose row in
+        indexed_results (as returned by load) is stale. Every archive
+        file is opened only once."""
+        stamps = ResultsArchive.read_results_stamps([p.results_arch for p in points])
+        return [p for p, stamp in zip(points, stamps) if self.is_stale(indexed_results[repr(p)], stamp)]
+    @staticmethod
+    def _decode_keys(keys):
+        return [k.decode('utf-8') if isinstance(k, bytes) else k for k in keys]
+    def _create_columns(self, index, results):
+        index.create_dataset('point',
+                             shape=(0,),
+                             maxshape=(None,),
+                             dtype=h5py.special_dtype(vlen=str))
+        for ds in self.datasets:
+            if np.ndim(results[ds]):
+                dtype = h5py.special_dtype(vlen=np.dtype('float64'))
+            else:
+                dtype = np.float64
+            index.create_dataset(ds, shape=(0,), maxshape=(None,), dtype=dtype)
+    def _create_signature_columns(self, index):
+        # indexes written before the results stamps were introduced
+        # lack these columns: their existing rows are marked as
+        # stale.
+        n_rows = index['point'].shape[0]
+        for name in self.signature_columns:
+            if name not in index:
+                index.create_dataset(name, shape=(n_rows,), maxshape=(None,), dtype=np.float64, fillvalue=np.nan)
+    def update(self, points):
+        """Add the results of the given points to the index, replacing
+        any existing row for the same point. The results must already
+        be loaded as attributes of the points, and stored in their
+        results archive."""
+        stamps = ResultsArchive.read_results_stamps([p.results_arch for p in points])
+        rows = []
+        for p, stamp in zip(points, stamps):
+            results = dict((ds, getattr(p, ds)) for ds in self.datasets)
+            results[ResultsArchive.stamp_attribute] = stamp
+            rows.append((repr(p), results))
+        if not rows:
+            return
+        try:
+            index = self._open()
+        except IOError as e:
+            # the index is only a cache of the results archives, so
+            # failing to update it is not a reason to fail.
+            print("Warning: can't update results index {0}. Error was: {1}".format(self.path, e))
+            return
+        try:
+            if 'point' not in index:
+                self._create_columns(index, rows[0][1])
+            self._create_signature_columns(index)
+            existing_keys = self._decode_keys(index['point'][...])
+            row_numbers = dict((key, n) for n, key in enumerate(existing_keys))
+            n_rows = len(existing_keys)
+            for key, results in rows:
+                if key not in row_numbers:
+                    row_numbers[key] = n_rows
+                    n_rows += 1
+            for name in ['point'] + self.datasets + self.signature_columns:
+                index[name].resize((n_rows,))
+            for key, results in rows:
+                n = row_numbers[key]
+                index['point'][n] = key
+                for ds in self.datasets + self.signature_columns:
+                    index[ds][n] = np.asarray(results[ds], dtype=np.float64)
+        finally:
+            self._close()
+    def load(self):
+        """Read the whole index. Return a dictionary mapping point
+        representations to name->data dictionaries of results,
+        including the stamp of the results they were read from when
+        available."""
+        if not os.path.isfile(self.path):
+            return {}
+        index = self._open(readonly=True)
+        try:
+            if index is None or 'point' not in index:
+                return {}
+            keys = self._decode_keys(index['point'][...])
+            names = self.datasets + [name for name in self.signature_columns if name in index]
+            columns = dict((name, index[name][...]) for name in names)
+        finally:
+            self._close()
+        return dict((key, dict((name, columns[name][n]) for name in names)) for n, key in enumerate(keys))
 
-def create_chunked_spike_dataset(group, name, data):
+def slice_spike_times(times, slice_starts, slice_length):
+    """Return the index of the time slice each spike time falls in, or -1
+    if it falls outside all of them. A spike t belongs to the slice
+    starting at s if s < t < s+slice_length. slice_starts must be
+    sorted and the slices must not overlap.
+
+    """
+    slice_starts = np.asarray(slice_starts, dtype=np.float64)
+    # index of the last slice starting strictly before each spike
+    slice_idxs = np.searchsorted(slice_starts, times, side='left') - 1
+    in_slice = slice_idxs >= 0
+    in_slice[in_slice] = times[in_slice] < slice_starts[slice_idxs[in_slice]] + slice_length
+    slice_idxs[~in_slice] = -1
+    return slice_idxs
+
+def create_chunked_spike_dataset(group, name, data, compression=None):
     # set chunk shapes for hdf5 compression of spike data. If the
     # spike times are 32-bit floats, a maximum-size chunk of 512 cells
     # by 128 spikes weighs 256kB. This is within the recommended chunk
@@ -159,8 +738,172 @@ def create_chunked_spike_dataset(group, name, data):
             chunk_shape = data.shape
         else:
             chunk_shape = (data.shape[0], max(1, np.floor(CHUNK_SIZE_MAX/data.shape[0])))
+        if compression is None:
+            compression = SpikesArchive.compression
         group.create_dataset(name,
                              data=data,
-                             compression='gzip',
-                             compression_opts=9,
-                             chunks=chunk_shape)
+                             chunks=chunk_shape,
+                             **compression.dataset_options())
+
+def create_csr_spike_datasets(archive, cell_type, n_cells, compression=None):
+    """Prepare the (initially empty) datasets that hold all the spikes
+    for a given cell type in the CSR archive layout.
+
+    In this layout, the spike trains of all cells in all observations
+    are concatenated in a single one-dimensional 'times' dataset,
+    ordered by stimulus pattern, trial and cell. The train of cell c
+    in observation o (that is, trial t of stimulus pattern s, with
+    o=s*n_trials+t) is times[indptr[o*n_cells+c]:indptr[o*n_cells+c+1]].
+
+    compression is a CompressionPolicy, and defaults to the one of
+    the SpikesArchive class. With delta encoding, 'times' holds
+    integer differences instead (see read_csr_trains).
+
+    """
+    if compression is None:
+        compression = SpikesArchive.compression
+    group = archive.require_group('spikes/{0}'.format(cell_type))
+    group.attrs['n_cells'] = n_cells
+    times_ds = group.create_dataset('times',
+                                    shape=(0,),
+                                    maxshape=(None,),
+                                    dtype=np.int32 if compression.delta else np.float32,
+                                    chunks=(CSR_CHUNK_SIZE,),
+                                    **compression.dataset_options())
+    if compression.delta:
+        times_ds.attrs['encoding'] = 'delta'
+        times_ds.attrs['resolution'] = compression.resolution
+    group.create_dataset('indptr',
+                         data=np.zeros(1, dtype=np.int64),
+                         maxshape=(None,),
+                         chunks=(CSR_CHUNK_SIZE,),
+                         **compression.dataset_options())
+    return group
+
+def read_csr_trains(group, first_train, last_train):
+    """Read the spike trains with indexes from first_train (included)
+    to last_train (excluded) from a CSR spike group. Return the spike
+    times, concatenated, and the slice of the indptr array that
+    describes them (whose values are offsets in the whole times
+    dataset).
+
+    """
+    indptr = group['indptr'][first_train:last_train+1]
+    times_ds = group['times']
+    times = times_ds[indptr[0]:indptr[-1]]
+    if times_ds.attrs.get('encoding', 'none') == 'delta':
+        # the first spike of every train is stored as is, the others
+        # as differences from the previous spike.
+        cumulative = np.cumsum(times.astype(np.int64))
+        train_starts = indptr[:-1] - indptr[0]
+        train_offsets = np.r_[0, cumulative][train_starts]
+        ticks = cumulative - np.repeat(train_offsets, np.diff(indptr))
+        times = (ticks * times_ds.attrs['resolution']).astype(np.float32)
+    return times, indptr
+
+def dense_to_csr_spikes(spikes):
+    """Convert a (max_n_spikes, n_cells) padded array of spike times,
+    such as the ones produced by the simulations, to a (times,
+    counts) pair, where times contains the spike trains of all cells
+    one after the other and counts the number of spikes of each
+    cell. Non-positive values are considered padding. An empty array
+    (completely silent network) gives empty times and counts.
+
+    """
+    if not np.size(spikes):
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+    spikes = np.atleast_2d(np.asarray(spikes, dtype=np.float32)).transpose()
+    is_spike = spikes > 0
+    return spikes[is_spike], is_spike.sum(axis=1)
+
+def append_csr_spikes(archive, cell_type, spikes):
+    """Append one observation, given as a dense (max_n_spikes, n_cells)
+    array of spike times, to the CSR datasets for the given cell
+    type. Observations must be appended in order."""
+    times, counts = dense_to_csr_spikes(spikes)
+    append_csr_trains(archive, cell_type, times, counts)
+
+def append_csr_trains(archive, cell_type, times, counts):
+    """Append one observation, given as a (times, counts) pair as
+    returned by dense_to_csr_spikes, to the CSR datasets for the given
+    cell type. Observations must be appended in order."""
+    group = archive['spikes/{0}'.format(cell_type)]
+    n_cells = group.attrs['n_cells']
+    if not counts.size:
+        # completely silent network
+        counts = np.zeros(n_cells, dtype=np.int64)
+    if counts.size != n_cells:
+        raise ValueError('Expected spikes for {0} cells, got {1}.'.format(n_cells, counts.size))
+    times_ds = group['times']
+    indptr_ds = group['indptr']
+    if times_ds.attrs.get('encoding', 'none') == 'delta':
+        ticks = np.round(times / times_ds.attrs['resolution']).astype(np.int64)
+        train_starts = (np.cumsum(counts) - counts)[counts > 0]
+        times = ticks.copy()
+        times[1:] -= ticks[:-1]
+        times[train_starts] = ticks[train_starts]
+        times = times.astype(np.int32)
+    n_spikes = times_ds.shape[0]
+    n_pointers = indptr_ds.shape[0]
+    if times.size:
+        times_ds.resize((n_spikes + times.size,))
+        times_ds[n_spikes:] = times
+    indptr_ds.resize((n_pointers + n_cells,))
+    indptr_ds[n_pointers:] = n_spikes + np.cumsum(counts)
+
+def create_sparse_adjacency_datasets(archive, adjacency):
+    """
+    Store the given binary (n_mf, n_grc) MF->GrC adjacency matrix in
+    the 'network_adjacency' group of the archive, as the indices and
+    indptr arrays of its CSR representation. Both are stored using
+    the smallest unsigned integer type that can hold them.
+
+    """
+    adjacency = sparse.csr_matrix(adjacency)
+    group = archive.create_group('network_adjacency')
+    group.attrs['shape'] = adjacency.shape
+    group.create_dataset('indices',
+                         data=adjacency.indices.astype(np.min_scalar_type(max(adjacency.shape[1]-1, 0))))
+    group.create_dataset('indptr',
+                         data=adjacency.indptr.astype(np.min_scalar_type(adjacency.nnz)))
+
+def read_sparse_adjacency(archive):
+    """
+    Rebuild the MF->GrC adjacency matrix stored in the archive as a
+    (n_mf, n_grc) scipy.sparse CSR matrix.
+
+    """
+    if 'network_adjacency' in archive:
+        group = archive['network_adjacency']
+        indices = group['indices'][...]
+        indptr = group['indptr'][...]
+        return sparse.csr_matrix((np.ones(indices.size, dtype=np.int8), indices, indptr),
+                                 shape=tuple(group.attrs['shape']))
+    else:
+        # older archives store the dense adjacency matrix of the whole
+        # network, with the MFs first.
+        n_mf = int(archive.attrs['n_mf'])
+        adjacency = np.asarray(archive['network_adjacency_matrix'])
+        return sparse.csr_matrix(adjacency[:n_mf,n_mf:], dtype=np.int8)
+
+def load_tar_simulation_spikes(tar_path, sim_refs):
+    """Read the spikes recorded in a set of simulations from the tar
+    archive where the simulation script stored them, without
+    extracting anything to disk.
+
+    Return a list with a ((mf_times, mf_counts), (grc_times,
+    grc_counts)) tuple for each simulation reference, in the format
+    returned by dense_to_csr_spikes, and the number of bytes of
+    simulation data that have been read.
+
+    """
+    trials = []
+    n_bytes = 0
+    with tarfile.open(tar_path) as tar_archive:
+        for sim_ref in sim_refs:
+            data = tar_archive.extractfile(sim_ref + '_.h5').read()
+            n_bytes += len(data)
+            with h5py.File(io.BytesIO(data), 'r') as spike_file:
+                trials.append((dense_to_csr_spikes(spike_file['MFs']['SPIKE_0'][...]),
+                               dense_to_csr_spikes(spike_file['GrCs']['SPIKE_min40'][...])))
+    return trials, n_bytes
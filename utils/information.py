@@ -0,0 +1,70 @@
+"""Estimation of the mutual information between the stimulus patterns
+and the output of a decoder, with the bias corrections used in the
+analysis (plugin, qe, pt and nsb, as defined by pyentropy).
+
+The decoded outputs for all the cluster counts analysed for a point
+are handled together. The plugin, Panzeri-Treves (pt) and quadratic
+extrapolation (qe) estimates are computed for all cluster counts at
+once by the numpy estimators in analysis.py, starting from joint
+output/stimulus contingency tables that are built only once. The
+costlier NSB estimates are left to pyentropy, and spread over a pool
+of worker processes.
+
+Decoded outputs are always given for observations ordered by
+stimulus pattern, with the same number of observations for each
+pattern, as in the testing set built by
+ParameterSpacePoint.run_analysis.
+
+"""
+import multiprocessing
+import numpy as np
+import pyentropy as pe
+
+from analysis import contingency_tables, plugin_mi, pt_mi, qe_mi
+
+METHODS = ('plugin', 'qe', 'pt', 'nsb')
+
+def _pyentropy_mi(job):
+    decoded_output, n_output_symbols, n_obs_per_sp, method = job
+    n_stim_patterns = decoded_output.size // n_obs_per_sp
+    s = pe.SortedDiscreteSystem(decoded_output,
+                                (1, n_output_symbols),
+                                n_stim_patterns,
+                                np.repeat(n_obs_per_sp, n_stim_patterns))
+    s.calculate_entropies(method=method, sampling='naive', calc=['HX', 'HXY'])
+    return s.I()
+
+def decoded_mi(decoded_outputs, n_output_symbols, n_obs_per_sp, methods=METHODS, n_workers=1, random_state=None):
+    """MI between stimulus patterns and each row of a (n_sets, n_obs)
+    stack of decoded outputs, with the given bias corrections.
+
+    n_output_symbols is the size of the output alphabet for each
+    row. random_state seeds the random splits of the data used by the
+    qe correction. Return a dictionary mapping each method to an array
+    of n_sets MI estimates.
+
+    """
+    decoded_outputs = np.atleast_2d(decoded_outputs)
+    n_output_symbols = np.asarray(n_output_symbols, dtype=int)
+    mi = {}
+    if 'plugin' in methods or 'pt' in methods:
+        tables = contingency_tables(decoded_outputs, n_output_symbols.max(), n_obs_per_sp)
+        if 'plugin' in methods:
+            mi['plugin'] = plugin_mi(tables)
+        if 'pt' in methods:
+            mi['pt'] = pt_mi(tables, n_output_symbols)
+    if 'qe' in methods:
+        mi['qe'] = qe_mi(decoded_outputs, n_output_symbols.max(), n_obs_per_sp, random_state=random_state)
+    pool_methods = [method for method in methods if method not in mi]
+    jobs = [(decoded_output, n_symbols, n_obs_per_sp, method) for method in pool_methods for decoded_output, n_symbols in zip(decoded_outputs, n_output_symbols)]
+    if n_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.map(_pyentropy_mi, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [_pyentropy_mi(job) for job in jobs]
+    n_sets = decoded_outputs.shape[0]
+    for k, method in enumerate(pool_methods):
+        mi[method] = np.array(results[k*n_sets:(k+1)*n_sets])
+    return mi
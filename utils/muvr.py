@@ -0,0 +1,89 @@
+"""Multi-unit van Rossum (MUVR) distances between sets of
+observations, computed with pymuvr.
+
+Observations are kept in a compact array-backed format
+(SpikeTrainSet) and only converted to the nested lists expected by
+pymuvr one block at a time, when the block is handed to a
+worker. Distance matrices are computed in blocks of observations,
+spread over a pool of worker processes.
+
+"""
+import multiprocessing
+import numpy as np
+
+class SpikeTrainSet(object):
+    """A set of observations, each of them composed of n_cells spike
+    trains, in CSR form: the spike train of cell c in the o-th
+    observation is times[indptr[o*n_cells+c]:indptr[o*n_cells+c+1]]."""
+    def __init__(self, times, indptr, n_cells):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.n_cells = int(n_cells)
+        self.n_obs = (self.indptr.size - 1) // self.n_cells
+    def __len__(self):
+        return self.n_obs
+    def subset(self, observations):
+        """Return a new SpikeTrainSet containing only the given
+        observations, in the given order."""
+        observations = np.asarray(observations, dtype=np.int64)
+        trains = (observations[:,np.newaxis] * self.n_cells + np.arange(self.n_cells)).ravel()
+        starts = self.indptr[trains]
+        lengths = self.indptr[trains+1] - starts
+        indptr = np.zeros(trains.size+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        # index of every selected spike in the original times array
+        spike_idxs = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return SpikeTrainSet(self.times[spike_idxs], indptr, self.n_cells)
+    def to_lists(self, start=0, stop=None):
+        """Convert observations start to stop to the nested-list format
+        used by pymuvr."""
+        if stop is None:
+            stop = self.n_obs
+        return [[self.times[self.indptr[o*self.n_cells+c]:self.indptr[o*self.n_cells+c+1]].tolist() for c in range(self.n_cells)] for o in range(start, stop)]
+
+# reference observations shared with the worker processes, set by
+# the pool initializer so that they are sent only once per worker.
+_references = None
+
+def _set_references(references):
+    global _references
+    _references = references
+
+def _distance_block(job):
+    observations, cos, tau = job
+    import pymuvr
+    return pymuvr.distance_matrix(observations, _references, cos, tau)
+
+def _map_blocks(observations, references, cos, tau, n_workers, block_size):
+    jobs = ((observations.to_lists(start, min(start+block_size, observations.n_obs)), cos, tau) for start in range(0, observations.n_obs, block_size))
+    reference_lists = references.to_lists()
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers,
+                                    initializer=_set_references,
+                                    initargs=(reference_lists,))
+        blocks = list(pool.imap(_distance_block, jobs))
+        pool.close()
+        pool.join()
+    else:
+        _set_references(reference_lists)
+        blocks = [_distance_block(job) for job in jobs]
+        _set_references(None)
+    return blocks
+
+def distance_matrix(observations, references, cos, tau, n_workers=1, block_size=256):
+    """(len(observations), len(references)) matrix of the MUVR
+    distances between two SpikeTrainSets, computed in blocks of
+    block_size observations on n_workers worker processes."""
+    blocks = _map_blocks(observations, references, cos, tau, n_workers, block_size)
+    return np.vstack(blocks + [np.zeros((0, references.n_obs))])
+
+def square_distance_matrix(observations, cos, tau, n_workers=1, block_size=256):
+    """Matrix of the MUVR distances between all pairs of observations in
+    a SpikeTrainSet. With a single worker this is a single call to
+    pymuvr.square_distance_matrix, which exploits the symmetry of the
+    matrix; with more workers, the matrix is computed in blocks of
+    rows as in distance_matrix."""
+    if n_workers > 1:
+        return distance_matrix(observations, observations, cos, tau, n_workers, block_size)
+    import pymuvr
+    return pymuvr.square_distance_matrix(observations.to_lists(), cos, tau)
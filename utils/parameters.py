@@ -1,16 +1,26 @@
 import numpy as np
-import itertools
 import functools
-import random
+import itertools
 import os.path
+import zlib
+import time
+import traceback
+import multiprocessing
 from matplotlib import pyplot as plt
 from scipy.cluster.hierarchy import linkage, fcluster
-from sklearn.cluster import KMeans
-import pyentropy as pe
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from pure import SimpleParameterSpacePoint, lazy_property
+from structures import load_network_structure
+import muvr
+from muvr import SpikeTrainSet
+from information import decoded_mi
+from archival import SpikesArchive, SharedSpikeData, ResultsArchive, ResultsIndex
+from analysis import convolve, multineuron_distance, multineuron_distance_labeled_line, hoyer_sparseness, activity_sparseness, vinje_sparseness, maxclust_n_clusters, iter_linkage_medoids, decode_nearest_medoid
 
-from pure import SimpleParameterSpacePoint
-from archival import SpikesArchive, ResultsArchive
-from analysis import convolve, multineuron_distance, multineuron_distance_labeled_line, hoyer_sparseness, activity_sparseness, vinje_sparseness
+# linkage methods for which the decoder is trained by clustering the
+# spike counts rather than the spike trains
+KMEANS_METHODS = ['kmeans', 'minibatch_kmeans', 'warm_kmeans']
 
 class PSlice(object):
     """
@@ -57,7 +67,7 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
         self.linkage_method = int(round(linkage_method))
         self.tau = tau
         self.dt = dt
-        self.linkage_method_string = ['ward', 'kmeans'][self.linkage_method]
+        self.linkage_method_string = ['ward', 'kmeans', 'minibatch_kmeans', 'warm_kmeans'][self.linkage_method]
         super(ParameterSpacePoint, self).__init__(n_grc_dend,
                                                   connectivity_rule,
                                                   input_spatial_correlation_scale,
@@ -118,15 +128,31 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
         spn_c = path_spn >= self.n_stim_patterns
         return all([sdur_c, n_trials_c, spn_c])
 
+    #-------------------
+    # Network structure
+    #-------------------
+    # the network structure is shared with all the other points
+    # using the same graphml file (see utils/structures.py). The
+    # networkx graph itself (network_graph) is still available, but
+    # is only parsed if explicitly accessed.
+    @lazy_property
+    def network_structure(self):
+        return load_network_structure(self.graphml_network_filename)
+    @lazy_property
+    def graph_mf_nodes(self):
+        return self.network_structure.mf_nodes.tolist()
+    @lazy_property
+    def graph_grc_nodes(self):
+        return self.network_structure.grc_nodes.tolist()
+    @lazy_property
+    def n_mf(self):
+        return self.network_structure.n_mf
+    @lazy_property
+    def n_grc(self):
+        return self.network_structure.n_grc
     def get_cell_positions(self):
-        cell_positions = {'MFs':np.zeros(shape=(self.n_mf, 3)),
-                          'GrCs':np.zeros(shape=(self.n_grc, 3))}
-        for node in self.network_graph.nodes():
-            cell, group_name = self.nC_cell_index_from_graph_node(node)
-            cell_positions[group_name][cell,0] = self.network_graph.node[node]['x']
-            cell_positions[group_name][cell,1] = self.network_graph.node[node]['y']
-            cell_positions[group_name][cell,2] = self.network_graph.node[node]['z']
-        return cell_positions
+        return {'MFs': self.network_structure.mf_positions.copy(),
+                'GrCs': self.network_structure.grc_positions.copy()}
 
     #-------------------
     # Simulation methods
@@ -140,7 +166,14 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
     #-------------------
     # Analysis methods
     #-------------------
-    def run_analysis(self):
+    def run_analysis(self, n_workers=None, spike_data=None):
+        if n_workers is None:
+            # use all the slots assigned to the job by the scheduler
+            n_workers = int(os.environ.get('NSLOTS', 1))
+        if spike_data is None:
+            # spike data can also be shared with other points that
+            # analyse the same spikes (see ParameterSpace.run_analysis)
+            spike_data = self.spikes_arch
         if self.results_arch.load():
             # we have the results already (loaded in memory or on the disk)
             pass
@@ -158,13 +191,28 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
             # choose training and testing set: trials are picked at random, but every stim pattern is represented equally (i.e., get the same number of trials) in both sets. Trials are ordered with respect to their stim pattern.
             n_tr_obs_per_sp = self.training_size
             n_ts_obs_per_sp = self.n_trials - n_tr_obs_per_sp
-            train_idxs = list(itertools.chain(*([x+self.n_trials*sp for x in random.sample(range(self.n_trials), n_tr_obs_per_sp)] for sp in range(self.n_stim_patterns))))
-            test_idxs = [x for x in range(n_obs) if x not in train_idxs]
+            # the split is stored in the results archive as soon as
+            # it's drawn, and reused if the analysis is run again.
+            train_idxs = self.results_arch.load_result('tr_indexes')
+            tr_indexes_seed = self.results_arch.load_result('tr_indexes_seed')
+            if tr_indexes_seed is None:
+                # the random generator is seeded by the point
+                # representation, so that the same split is drawn for
+                # the same point.
+                tr_indexes_seed = zlib.crc32(repr(self).encode('utf-8')) & 0x7fffffff
+            tr_indexes_seed = int(tr_indexes_seed)
+            if train_idxs is None:
+                rng = np.random.RandomState(tr_indexes_seed)
+                tr_trials = np.sort(np.argsort(rng.uniform(size=(self.n_stim_patterns, self.n_trials)), axis=1)[:,:n_tr_obs_per_sp], axis=1)
+                train_idxs = (tr_trials + self.n_trials * np.arange(self.n_stim_patterns)[:,np.newaxis]).ravel()
+                with self.results_arch.batch():
+                    self.results_arch.update_result('tr_indexes', data=train_idxs)
+                    self.results_arch.update_result('tr_indexes_seed', data=tr_indexes_seed)
+            train_mask = np.zeros(n_obs, dtype=bool)
+            train_mask[train_idxs] = True
+            test_idxs = np.flatnonzero(~train_mask)
             n_tr_obs = len(train_idxs)
             n_ts_obs = len(test_idxs)
-            Ym = self.n_stim_patterns
-            Ny = np.array([n_ts_obs_per_sp for each in range(self.n_stim_patterns)])
-            Xn = 1 # the output is effectively one-dimensional
             # initialize data structures for storage of results
             ts_decoded_mi_plugin = np.zeros(n_obs)
             ts_decoded_mi_qe = np.zeros(n_obs)
@@ -174,8 +222,8 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
             # compute mutual information by using direct clustering on training data (REMOVED)
             # --note: fcluster doesn't work in the border case with n_clusts=n_obs, as it never returns the trivial clustering. Cluster number 0 is never present in a clustering.
             print('counting spikes in output spike trains')
-            i_level_array = self.spikes_arch.get_spike_counts(cell_type='mf')
-            o_level_array = self.spikes_arch.get_spike_counts(cell_type='grc')
+            i_level_array = spike_data.get_spike_counts(cell_type='mf')
+            o_level_array = spike_data.get_spike_counts(cell_type='grc')
             print('computing mean input and output spike counts')
             i_mean_count = i_level_array.mean()
             o_mean_count = o_level_array.mean()
@@ -188,108 +236,179 @@ class ParameterSpacePoint(SimpleParameterSpacePoint):
             o_sparseness_vinje = vinje_sparseness(o_level_array)
             print('input sparseness: hoyer {:.2f}, vinje {:.2f}, activity {:.2f}'.format(i_sparseness_hoyer, i_sparseness_vinje, i_sparseness_activity))
             print('output sparseness: hoyer {:.2f}, vinje {:.2f}, activity {:.2f}'.format(o_sparseness_hoyer, o_sparseness_vinje, o_sparseness_activity))
-            if self.linkage_method_string == 'kmeans':
+            if self.linkage_method_string in KMEANS_METHODS:
                 spike_counts = o_level_array
                 # divide spike count data in training and testing set
-                tr_spike_counts = np.array([spike_counts[o] for o in train_idxs])
-                ts_spike_counts = np.array([spike_counts[o] for o in test_idxs])
-                for n_clusts in range(min_clusts_analysed, max_clusts_analysed+1, clusts_step):
-                    clustering = KMeans(n_clusters=n_clusts)
+                tr_spike_counts = spike_counts[train_idxs]
+                ts_spike_counts = spike_counts[test_idxs]
+                n_clusts_range = range(min_clusts_analysed, max_clusts_analysed+1, clusts_step)
+                decoded_outputs = []
+                for n_clusts in n_clusts_range:
+                    if self.linkage_method_string == 'minibatch_kmeans':
+                        clustering = MiniBatchKMeans(n_clusters=n_clusts)
+                    elif self.linkage_method_string == 'warm_kmeans' and n_clusts == self.n_stim_patterns:
+                        # start from the mean response to each stimulus
+                        # pattern (the training set is ordered by
+                        # stimulus pattern, with the same number of
+                        # trials for each), and run k-means only once.
+                        class_means = tr_spike_counts.reshape(self.n_stim_patterns, n_tr_obs_per_sp, -1).mean(axis=1)
+                        clustering = KMeans(n_clusters=n_clusts, init=class_means, n_init=1)
+                    else:
+                        clustering = KMeans(n_clusters=n_clusts)
                     print('performing k-means clustering on training set (training the decoder) for k='+str(n_clusts))
                     clustering.fit(tr_spike_counts)
                     print('using the decoder trained with k-means clustering to classify data points in testing set')
-                    decoded_output = clustering.predict(ts_spike_counts)
-                    # calculate MI
-                    print('calculating MI')
-                    Xm = n_clusts
-                    X_dims = (Xn, Xm)
-                    X = decoded_output
-                    s = pe.SortedDiscreteSystem(X, X_dims, Ym, Ny)
-                    s.calculate_entropies(method='plugin', calc=['HX', 'HXY'])
-                    ts_decoded_mi_plugin[n_clusts-1] = s.I()
-                    s.calculate_entropies(method='qe', sampling='naive', calc=['HX', 'HXY'], qe_method='plugin')
-                    ts_decoded_mi_qe[n_clusts-1] = s.I()
-                    s.calculate_entropies(method='pt', sampling='naive', calc=['HX', 'HXY'])
-                    ts_decoded_mi_pt[n_clusts-1] = s.I()
-                    s.calculate_entropies(method='nsb', sampling='naive', calc=['HX', 'HXY'])
-                    ts_decoded_mi_nsb[n_clusts-1] = s.I()            
+                    decoded_outputs.append(clustering.predict(ts_spike_counts))
             else:
                 tr_tree = np.zeros(shape=(n_tr_obs-1, 3))
-                import pymuvr
-                spikes = self.spikes_arch.get_spikes(cell_type='grc')
-                self.spikes_arch.load_attrs()
-                tr_spikes = [spikes[o] for o in train_idxs]
-                ts_spikes = [spikes[o] for o in test_idxs]
+                times, indptr = spike_data.get_spike_trains(cell_type='grc')
+                spikes = SpikeTrainSet(times, indptr, spike_data.attrs['n_grc'])
+                tr_spikes = spikes.subset(train_idxs)
+                ts_spikes = spikes.subset(test_idxs)
 
                 # compute multineuron distance between each pair of training observations
                 print('calculating distances between training observations')
-                tr_distances = pymuvr.square_distance_matrix(tr_spikes,
-                                                             self.multineuron_metric_mixing,
-                                                             self.tau)
+                tr_distances = muvr.square_distance_matrix(tr_spikes,
+                                                           self.multineuron_metric_mixing,
+                                                           self.tau,
+                                                           n_workers=n_workers)
                 # cluster training data
                 print('clustering training data')
                 tr_tree = linkage(tr_distances, method=self.linkage_method_string)
 
+                # every element of the output alphabet is a training
+                # observation, so the distances between the testing
+                # and training observations are all we need to decode
+                # the testing set for any number of clusters.
+                print('calculating distances between testing and training observations')
+                ts_tr_distances = muvr.distance_matrix(ts_spikes,
+                                                       tr_spikes,
+                                                       self.multineuron_metric_mixing,
+                                                       self.tau,
+                                                       n_workers=n_workers)
+
                 # train the decoder and use it to calculate mi on the testing dataset
                 print("training the decoder and using it to calculate mi on test data")
 
                 tr_distances_square = np.square(tr_distances)
 
-                for n_clusts in range(min_clusts_analysed, max_clusts_analysed+1):
-                    # iterate over the number of clusters and, step by
-                    # step, train the decoder and use it to calculate mi
-                    tr_clustering = fcluster(tr_tree, t=n_clusts, criterion='maxclust')
-                    out_alphabet = []
-                    for c in range(1,n_clusts+1):
-                        # every cluster is represented in the output
-                        # alphabet by the element which minimizes the sum
-                        # of intra-cluster square distances
-                        obs_in_c = [ob for ob in range(n_tr_obs) if tr_clustering[ob]==c]
-                        sum_of_intracluster_square_distances = tr_distances_square[obs_in_c,:][:,obs_in_c].sum(axis=1)
-                        out_alphabet.append(tr_spikes[np.argmin(sum_of_intracluster_square_distances)])
-                    distances = pymuvr.distance_matrix(ts_spikes,
-                                                       out_alphabet,
-                                                       self.multineuron_metric_mixing,
-                                                       self.tau)
-                    # each observation in the testing set is decoded by
-                    # assigning it to the cluster whose representative
-                    # element it's closest to
-                    decoded_output = distances.argmin(axis=1)
-                    # calculate MI
-                    Xm = n_clusts
-                    X_dims = (Xn, Xm)
-                    X = decoded_output
-                    s = pe.SortedDiscreteSystem(X, X_dims, Ym, Ny)
-                    s.calculate_entropies(method='qe', sampling='naive', calc=['HX', 'HXY'], qe_method='plugin')
-                    ts_decoded_mi_qe[n_clusts-1] = s.I()
-                    s.calculate_entropies(method='pt', sampling='naive', calc=['HX', 'HXY'])
-                    ts_decoded_mi_pt[n_clusts-1] = s.I()
-                    s.calculate_entropies(method='nsb', sampling='naive', calc=['HX', 'HXY'])
-                    ts_decoded_mi_nsb[n_clusts-1] = s.I()            
-                    if n_clusts == self.n_stim_patterns:
-                        px_at_same_size_point = s.PX 
-                # save linkage tree to results archive (only if
-                # performing hierarchical clustering)
-                self.results_arch.update_result('tr_linkage', data=tr_tree)
-
-            # save analysis results in the archive
+                # every cluster is represented in the output alphabet
+                # by the element which minimizes the sum of
+                # intra-cluster square distances. The representatives
+                # for all the cluster counts we need are found in a
+                # single walk down the linkage tree.
+                n_clusters_formed = dict((n_clusts, maxclust_n_clusters(tr_tree, n_clusts)) for n_clusts in range(min_clusts_analysed, max_clusts_analysed+1))
+                tr_medoids = {}
+                for n_clusters, medoids in enumerate(iter_linkage_medoids(tr_tree, tr_distances_square, max(n_clusters_formed.values())), 1):
+                    if n_clusters in n_clusters_formed.values():
+                        tr_medoids[n_clusters] = medoids
+
+                # each observation in the testing set is decoded by
+                # assigning it to the cluster whose representative
+                # element it's closest to. This is done for all the
+                # cluster counts at once.
+                n_clusts_range = range(min_clusts_analysed, max_clusts_analysed+1)
+                decoded_outputs = decode_nearest_medoid(ts_tr_distances,
+                                                        [tr_medoids[n_clusters_formed[n_clusts]] for n_clusts in n_clusts_range])
+
+            # calculate MI from the decoded outputs, for all the
+            # cluster counts and bias corrections at once
+            print('calculating MI')
+            # the random splits used by the qe correction are seeded
+            # like the train/test split, so that a repeated or resumed
+            # analysis gives the same estimates.
+            mi = decoded_mi(decoded_outputs,
+                            n_clusts_range,
+                            n_ts_obs_per_sp,
+                            n_workers=n_workers,
+                            random_state=tr_indexes_seed)
+            mi_idxs = np.array(n_clusts_range) - 1
+            ts_decoded_mi_plugin[mi_idxs] = mi['plugin']
+            ts_decoded_mi_qe[mi_idxs] = mi['qe']
+            ts_decoded_mi_pt[mi_idxs] = mi['pt']
+            ts_decoded_mi_nsb[mi_idxs] = mi['nsb']
+
+            # save analysis results in the archive, locking and
+            # opening it only once. This also sets the results as
+            # attributes of the point.
             print('updating results archive')
-            self.results_arch.update_result('ts_decoded_mi_plugin', data=ts_decoded_mi_plugin)
-            self.results_arch.update_result('ts_decoded_mi_qe', data=ts_decoded_mi_qe)
-            self.results_arch.update_result('ts_decoded_mi_pt', data=ts_decoded_mi_pt)
-            self.results_arch.update_result('ts_decoded_mi_nsb', data=ts_decoded_mi_nsb)
-
-            self.results_arch.update_result('i_mean_count', data=i_mean_count)
-            self.results_arch.update_result('o_mean_count', data=o_mean_count)
-            self.results_arch.update_result('i_sparseness_hoyer', data=i_sparseness_hoyer)
-            self.results_arch.update_result('i_sparseness_activity', data=i_sparseness_activity)
-            self.results_arch.update_result('i_sparseness_vinje', data=i_sparseness_vinje)
-            self.results_arch.update_result('o_sparseness_hoyer', data=o_sparseness_hoyer)
-            self.results_arch.update_result('o_sparseness_activity', data=o_sparseness_activity)
-            self.results_arch.update_result('o_sparseness_vinje', data=o_sparseness_vinje)
-            # update attributes
-            self.results_arch.load()
+            with self.results_arch.batch():
+                if self.linkage_method_string == 'ward':
+                    # save linkage tree to results archive (only if
+                    # performing hierarchical clustering)
+                    self.results_arch.update_result('tr_linkage', data=tr_tree)
+                self.results_arch.update_result('ts_decoded_mi_plugin', data=ts_decoded_mi_plugin)
+                self.results_arch.update_result('ts_decoded_mi_qe', data=ts_decoded_mi_qe)
+                self.results_arch.update_result('ts_decoded_mi_pt', data=ts_decoded_mi_pt)
+                self.results_arch.update_result('ts_decoded_mi_nsb', data=ts_decoded_mi_nsb)
 
+                self.results_arch.update_result('i_mean_count', data=i_mean_count)
+                self.results_arch.update_result('o_mean_count', data=o_mean_count)
+                self.results_arch.update_result('i_sparseness_hoyer', data=i_sparseness_hoyer)
+                self.results_arch.update_result('i_sparseness_activity', data=i_sparseness_activity)
+                self.results_arch.update_result('i_sparseness_vinje', data=i_sparseness_vinje)
+                self.results_arch.update_result('o_sparseness_hoyer', data=o_sparseness_hoyer)
+                self.results_arch.update_result('o_sparseness_activity', data=o_sparseness_activity)
+                self.results_arch.update_result('o_sparseness_vinje', data=o_sparseness_vinje)
+            # register the new results in the parameter-space-wide
+            # results index
+            ResultsIndex(self.BASE_DIR).update([self])
+
+def _analysis_window(point):
+    """Identify the spikes analysed by a point: points with the same
+    analysis window read the same spikes from the same archive."""
+    return (point.spikes_arch.path, point.n_stim_patterns, point.n_trials, point.sim_duration, point.ana_duration)
+
+def _analyse_point(point, spike_data, n_workers=None):
+    """Run the analysis of a point. Return the formatted traceback of
+    the error that interrupted it, if any."""
+    try:
+        point.run_analysis(n_workers=n_workers, spike_data=spike_data)
+    except Exception:
+        return traceback.format_exc()
+
+def _load_spike_data(group):
+    """Read from the spike archive of a group of points all the spike
+    data analysed by the points in the group: the input and output
+    spike counts, and the output spike trains if some point needs
+    them to train its decoder."""
+    spike_data = SharedSpikeData(group[0].spikes_arch)
+    # the archive attributes are read lazily
+    spike_data.attrs
+    spike_data.get_spike_counts(cell_type='mf')
+    spike_data.get_spike_counts(cell_type='grc')
+    if any(p.linkage_method_string not in KMEANS_METHODS for p in group):
+        spike_data.get_spike_trains(cell_type='grc')
+    return spike_data
+
+def _analysis_waves(groups, n_workers):
+    """Split a list of groups of points into consecutive waves of whole
+    groups, each with at least n_workers points (except possibly the
+    last one)."""
+    wave = []
+    for group in groups:
+        wave.append(group)
+        if sum(len(g) for g in wave) >= n_workers:
+            yield wave
+            wave = []
+    if wave:
+        yield wave
+
+# spike data of the groups of points being analysed by
+# ParameterSpace.run_analysis, keyed by analysis window. It's loaded
+# by the parent process before the pool of workers is started, and
+# the workers inherit it when they are forked.
+_shared_spike_data = {}
+
+def _analyse_point_in_worker(point_repr):
+    """Worker function for ParameterSpace.run_analysis. Points are
+    passed by their representation, and each of them is analysed in a
+    single process, as the workers of a pool can't start pools of
+    their own. The spike data is the one loaded for the point's group
+    by the parent process."""
+    point = eval(point_repr)
+    spike_data = _shared_spike_data[_analysis_window(point)]
+    return point_repr, _analyse_point(point, spike_data, n_workers=1)
 
 # A numpy ndarray with object dtype, and composed of (ParameterSpacePoint)s.
 ParameterSpaceMesh = np.vectorize(ParameterSpacePoint)
@@ -517,11 +636,131 @@ class ParameterSpace(np.ndarray):
     #-------------------
     # Analysis methods
     #-------------------
-    def run_analysis(self):
-        for p in self.flat:
-            p.run_analysis()
-    def load_analysis_results(self):
-        return [p.results_arch.load() for p in self.flat]
+    def analysis_groups(self, points=None):
+        """Group the points in the space (or the given points) which
+        analyse the same window of the same spike archive, and
+        therefore only differ in analysis coordinates such as
+        training_size, tau, multineuron_metric_mixing or
+        linkage_method. Return a list of lists of points."""
+        if points is None:
+            points = self.flat
+        groups = {}
+        for p in points:
+            groups.setdefault(_analysis_window(p), []).append(p)
+        return list(groups.values())
+    def run_analysis(self, n_workers=1, max_retries=2):
+        """Analyse all the points in the space, starting from the most
+        expensive ones (as estimated by
+        n_stim_patterns*n_trials*n_grc).
+
+        Points whose results can already be loaded are skipped. The
+        others are analysed in groups that share the same spikes (see
+        analysis_groups), and groups are analysed in waves of at least
+        n_workers points. Before each wave, the spike counts and
+        spike trains for its groups are read once, in this process,
+        and kept in memory until the wave is done.
+
+        With n_workers > 1, the points of a wave are analysed in
+        parallel by a pool of worker processes, started after the
+        spikes are read. The workers are forked, and inherit the spike
+        data instead of reading it again. The points of a group are
+        handed out one by one, so that a large group is spread over
+        all the workers. Points that share a results archive can be
+        analysed at the same time, as every access to the archive is
+        locked. The analysis of points which fail is attempted again
+        up to max_retries times. If some points still can't be
+        analysed, the results of the others are loaded and an
+        exception listing the failed points is raised.
+
+        """
+        points = dict((repr(p), p) for p in self.flat)
+        cost = lambda p: p.n_stim_patterns * p.n_trials * p.n_grc
+        pending = [p for p in points.values() if not p.results_arch.load()]
+        n_points = len(points)
+        n_analysed = n_points - len(pending)
+        start_time = time.time()
+        for attempt in range(max_retries+1):
+            if attempt > 0:
+                print('retrying analysis of {} failed points (attempt {}/{})'.format(len(pending), attempt, max_retries))
+            groups = sorted(self.analysis_groups(pending), key=lambda g: sum(cost(p) for p in g), reverse=True)
+            failed = []
+            for wave in _analysis_waves(groups, n_workers):
+                loading_errors = []
+                wave_points = []
+                for group in wave:
+                    try:
+                        _shared_spike_data[_analysis_window(group[0])] = _load_spike_data(group)
+                        wave_points.extend(group)
+                    except Exception:
+                        error = traceback.format_exc()
+                        loading_errors.extend((repr(p), error) for p in group)
+                pool = None
+                if n_workers > 1 and len(wave_points) > 1:
+                    pool = multiprocessing.Pool(min(n_workers, len(wave_points)))
+                    outcomes = pool.imap_unordered(_analyse_point_in_worker, [repr(p) for p in wave_points])
+                else:
+                    outcomes = ((repr(p), _analyse_point(p, _shared_spike_data[_analysis_window(p)])) for p in wave_points)
+                completed = False
+                try:
+                    for point_repr, error in itertools.chain(loading_errors, outcomes):
+                        if error is None:
+                            n_analysed += 1
+                        else:
+                            failed.append(points[point_repr])
+                            print('analysis of {} failed! Error was:\n{}'.format(point_repr, error))
+                        print('{}/{} points analysed | {} failed | {:.1f}s elapsed'.format(n_analysed,
+                                                                                          n_points,
+                                                                                          len(failed),
+                                                                                          time.time()-start_time))
+                    completed = True
+                finally:
+                    if pool is not None:
+                        # don't leave the workers running if we are
+                        # interrupted or the pool breaks down
+                        if completed:
+                            pool.close()
+                        else:
+                            pool.terminate()
+                        pool.join()
+                    _shared_spike_data.clear()
+            pending = failed
+            if not pending:
+                break
+        # results computed by the worker processes are only on disk
+        self.load_analysis_results()
+        if pending:
+            raise Exception("Analysis failed for {} points after {} retries:\n{}".format(len(pending),
+                                                                                         max_retries,
+                                                                                         '\n'.join(repr(p) for p in pending)))
+    def load_analysis_results(self, use_index=True):
+        """Load the analysis results for all points in the space. If
+        use_index is True, the results are first read in bulk from
+        the results index, and only the points missing from the index
+        or whose index entry is stale are loaded from their own
+        results archive. Stale index entries are then refreshed."""
+        stale = []
+        if use_index and self.size:
+            index = ResultsIndex(self.flat[0].BASE_DIR)
+            indexed_results = index.load()
+            indexed = [p for p in self.flat if not p.results_arch._has_been_loaded() and repr(p) in indexed_results]
+            stale = index.stale_points(indexed, indexed_results)
+            stale_reprs = set(repr(p) for p in stale)
+            for p in indexed:
+                if repr(p) not in stale_reprs:
+                    p.results_arch._set_point_attributes(indexed_results[repr(p)])
+        loaded = [p.results_arch.load() for p in self.flat]
+        refreshed = [p for p in stale if p.results_arch._has_been_loaded()]
+        if refreshed:
+            index.update(refreshed)
+        return loaded
+    def update_results_index(self):
+        """Add to the results index all the points in the space whose
+        results can be found in their results archive. Useful to build
+        the index for points analysed before it existed."""
+        loaded = [p for p in self.flat if p.results_arch.load()]
+        if loaded:
+            ResultsIndex(loaded[0].BASE_DIR).update(loaded)
+        return len(loaded)
     #-------------------
     # Visualisation methods
     #-------------------
@@ -4,6 +4,25 @@ import networkx as nx
 BASE_DIR = "/home/ucbtepi/code/network/data"
 SIM_DECORRELATION_TIME = 30
 
+class lazy_property(object):
+    """Decorator for attributes that are expensive to compute. The
+    decorated method is called on first access, and its result is
+    stored in the instance dictionary, where it shadows the
+    descriptor on subsequent accesses (and can be overridden by plain
+    assignment).
+
+    """
+    def __init__(self, method):
+        self.method = method
+        self.name = method.__name__
+        self.__doc__ = method.__doc__
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.method(instance)
+        setattr(instance, self.name, value)
+        return value
+
 class SimpleParameterSpacePoint(object):
     """Used in the simulation script and as a base class for ParameterSpacePoint"""
     #--class constants
@@ -66,6 +85,13 @@ class SimpleParameterSpacePoint(object):
                                                                                                     self.stim_rate_sigma,
                                                                                                     self.noise_rate_mu,
                                                                                                     self.noise_rate_sigma)
+        # the spike archive path and the network structure are only
+        # looked up when needed (see the lazy properties below), as
+        # building large parameter spaces would otherwise require
+        # parsing the same graphml files and scanning the same data
+        # folders over and over.
+    @lazy_property
+    def spike_archive_path(self):
         # the spike archive the point gets associated with can be an
         # archive for a larger set of simulations. For example, if
         # this point has n_stim_patterns=128, n_trials=50 and
@@ -74,20 +100,31 @@ class SimpleParameterSpacePoint(object):
         # n_stim_patterns=1024, n_trials=100 and sim_duration=200, the
         # larger archive will be reused to avoid rerunning the same
         # simulations.
-        self.spike_archive_path = self.get_existing_spike_archive_path()
-        if not self.spike_archive_path:
-            self.spike_archive_path = "{0}/sp{1}_t{2}_sdur{3}.hdf5".format(self.data_folder_path,
-                                                                           self.n_stim_patterns,
-                                                                           self.n_trials,
-                                                                           self.sim_duration)
-        #--useful quantities
-        self.network_graph = nx.read_graphml(self.graphml_network_filename,
-                                             node_type=int)
-        self.graph_mf_nodes = [n for n,d in self.network_graph.nodes(data=True) if d['bipartite']==0]
-        self.graph_grc_nodes = [n for n,d in self.network_graph.nodes(data=True) if d['bipartite']==1]
-        self.n_mf = len(self.graph_mf_nodes)
-        self.n_grc = len(self.graph_grc_nodes)
-        assert self.n_mf + self.n_grc == self.network_graph.number_of_nodes()
+        path = self.get_existing_spike_archive_path()
+        if not path:
+            path = "{0}/sp{1}_t{2}_sdur{3}.hdf5".format(self.data_folder_path,
+                                                        self.n_stim_patterns,
+                                                        self.n_trials,
+                                                        self.sim_duration)
+        return path
+    @lazy_property
+    def network_graph(self):
+        return nx.read_graphml(self.graphml_network_filename,
+                               node_type=int)
+    @lazy_property
+    def graph_mf_nodes(self):
+        return [n for n,d in self.network_graph.nodes(data=True) if d['bipartite']==0]
+    @lazy_property
+    def graph_grc_nodes(self):
+        grc_nodes = [n for n,d in self.network_graph.nodes(data=True) if d['bipartite']==1]
+        assert len(self.graph_mf_nodes) + len(grc_nodes) == self.network_graph.number_of_nodes()
+        return grc_nodes
+    @lazy_property
+    def n_mf(self):
+        return len(self.graph_mf_nodes)
+    @lazy_property
+    def n_grc(self):
+        return len(self.graph_grc_nodes)
     def representation(self):
         # MUST NOT HAVE SPACES (see how simulations are submitted)
         return "SimpleParameterSpacePoint(%d,%d,%f,%f,%f,%f,%f,%f,%d,%d,%d,%d,%d,%d,%d,%d)" % (self.n_grc_dend, self.connectivity_rule, self.input_spatial_correlation_scale, self.active_mf_fraction, self.gaba_scale, self.dta, self.inh_cond_scaling, self.exc_cond_scaling, self.modulation_frequency, self.stim_rate_mu, self.stim_rate_sigma, self.noise_rate_mu, self.noise_rate_sigma, self.n_stim_patterns, self.n_trials, self.sim_duration)
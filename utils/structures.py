@@ -0,0 +1,132 @@
+"""Compact, shared representation of the network structures used by
+the parameter space points.
+
+Many points share the same network structure (the same n_grc_dend
+and connectivity_rule), so instead of having each point parse its
+own copy of the graphml file, structures are loaded once per process
+through load_network_structure and then shared.
+
+Parsing graphml is slow, so structures can also be compiled to an
+hdf5 file next to the graphml one (see
+scripts/compile_network_structures.py). When such a file is present
+and up to date, its contiguous datasets are memory-mapped instead.
+
+"""
+import os.path
+import numpy as np
+import networkx as nx
+import h5py
+from scipy import sparse
+
+class NetworkStructure(object):
+    """MF->GrC network structure as numpy arrays. Cells are indexed
+    as in neuroConstruct (see
+    SimpleParameterSpacePoint.nC_cell_index_from_graph_node), so
+    that mf_positions[i] is the position of the i-th MF and
+    adjacency[i,j] is 1 if the i-th MF projects to the j-th GrC.
+
+    The arrays are shared by all the points using the structure, and
+    are therefore read-only.
+
+    """
+    def __init__(self, mf_nodes, grc_nodes, mf_positions, grc_positions, adjacency):
+        self.mf_nodes = np.asarray(mf_nodes)
+        self.grc_nodes = np.asarray(grc_nodes)
+        self.mf_positions = np.asarray(mf_positions)
+        self.grc_positions = np.asarray(grc_positions)
+        self.adjacency = sparse.csr_matrix(adjacency)
+        for array in [self.mf_nodes, self.grc_nodes, self.mf_positions, self.grc_positions]:
+            array.setflags(write=False)
+    @property
+    def n_mf(self):
+        return self.mf_nodes.size
+    @property
+    def n_grc(self):
+        return self.grc_nodes.size
+    @classmethod
+    def from_graphml(cls, path):
+        graph = nx.read_graphml(path, node_type=int)
+        mf_nodes = [n for n,d in graph.nodes(data=True) if d['bipartite']==0]
+        grc_nodes = [n for n,d in graph.nodes(data=True) if d['bipartite']==1]
+        assert len(mf_nodes) + len(grc_nodes) == graph.number_of_nodes()
+        n_mf = len(mf_nodes)
+        n_grc = len(grc_nodes)
+        mf_positions = np.zeros(shape=(n_mf, 3))
+        grc_positions = np.zeros(shape=(n_grc, 3))
+        for node, d in graph.nodes(data=True):
+            if node <= n_mf:
+                mf_positions[node-1] = d['x'], d['y'], d['z']
+            else:
+                grc_positions[node-(n_mf+1)] = d['x'], d['y'], d['z']
+        edges = np.array([sorted(edge) for edge in graph.edges()], dtype=np.int64).reshape(-1, 2)
+        adjacency = sparse.csr_matrix((np.ones(edges.shape[0], dtype=np.int8),
+                                       (edges[:,0]-1, edges[:,1]-(n_mf+1))),
+                                      shape=(n_mf, n_grc))
+        return cls(mf_nodes, grc_nodes, mf_positions, grc_positions, adjacency)
+    def save(self, path):
+        """Write the structure to an hdf5 file that can be loaded with
+        from_compiled. Datasets are stored contiguous and
+        uncompressed, so that they can be memory-mapped."""
+        with h5py.File(path, 'w') as hdf5_handle:
+            hdf5_handle.attrs['n_mf'] = self.n_mf
+            hdf5_handle.attrs['n_grc'] = self.n_grc
+            hdf5_handle.create_dataset('mf_nodes', data=self.mf_nodes)
+            hdf5_handle.create_dataset('grc_nodes', data=self.grc_nodes)
+            hdf5_handle.create_dataset('mf_positions', data=self.mf_positions)
+            hdf5_handle.create_dataset('grc_positions', data=self.grc_positions)
+            hdf5_handle.create_dataset('adjacency_data', data=self.adjacency.data)
+            hdf5_handle.create_dataset('adjacency_indices', data=self.adjacency.indices)
+            hdf5_handle.create_dataset('adjacency_indptr', data=self.adjacency.indptr)
+    @classmethod
+    def from_compiled(cls, path):
+        arrays = {}
+        with h5py.File(path, 'r') as hdf5_handle:
+            n_mf = int(hdf5_handle.attrs['n_mf'])
+            n_grc = int(hdf5_handle.attrs['n_grc'])
+            for name, ds in hdf5_handle.items():
+                offset = ds.id.get_offset()
+                if offset is None:
+                    # no storage allocated (empty dataset)
+                    arrays[name] = ds[...]
+                else:
+                    arrays[name] = np.memmap(path,
+                                             dtype=ds.dtype,
+                                             mode='r',
+                                             offset=offset,
+                                             shape=ds.shape)
+        adjacency = sparse.csr_matrix((arrays['adjacency_data'],
+                                       arrays['adjacency_indices'],
+                                       arrays['adjacency_indptr']),
+                                      shape=(n_mf, n_grc))
+        return cls(arrays['mf_nodes'],
+                   arrays['grc_nodes'],
+                   arrays['mf_positions'],
+                   arrays['grc_positions'],
+                   adjacency)
+
+def compiled_structure_path(graphml_path):
+    return graphml_path.rpartition('.graphml')[0] + '_structure.hdf5'
+
+# process-wide cache of the structures loaded so far, keyed by
+# (path, modification time) of the file they were loaded from.
+_structure_cache = {}
+
+def load_network_structure(graphml_path):
+    """Return the NetworkStructure described by the given graphml file,
+    loading it only if it hasn't been loaded yet by this process or
+    if the file has changed since. The compiled version of the
+    structure is used if it is at least as recent as the graphml
+    file."""
+    compiled_path = compiled_structure_path(graphml_path)
+    if os.path.isfile(compiled_path) and (not os.path.isfile(graphml_path) or os.path.getmtime(compiled_path) >= os.path.getmtime(graphml_path)):
+        path = compiled_path
+        loader = NetworkStructure.from_compiled
+    else:
+        path = graphml_path
+        loader = NetworkStructure.from_graphml
+    key = (path, os.path.getmtime(path))
+    if key not in _structure_cache:
+        for stale_key in [k for k in _structure_cache if k[0] == path]:
+            del _structure_cache[stale_key]
+        _structure_cache[key] = loader(path)
+    return _structure_cache[key]
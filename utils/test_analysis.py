@@ -0,0 +1,112 @@
+import unittest
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from analysis import contingency_tables, plugin_mi, pt_mi, qe_mi, pairwise_distances
+
+try:
+    import pyentropy as pe
+except ImportError:
+    pe = None
+
+def random_decoded_outputs(n_stim_patterns, n_obs_per_sp, n_output_symbols, seed=0):
+    """A mix of informative and uninformative decoded outputs, one row
+    for each alphabet size in n_output_symbols."""
+    rng = np.random.RandomState(seed)
+    stimuli = np.repeat(np.arange(n_stim_patterns), n_obs_per_sp)
+    return np.array([np.where(rng.uniform(size=stimuli.size) < 0.5, stimuli % n, rng.randint(n, size=stimuli.size)) for n in n_output_symbols])
+
+class TestInformationEstimators(unittest.TestCase):
+    def test_plugin_formula(self):
+        n_stim_patterns, n_obs_per_sp, n_output_symbols = 20, 16, [3, 10, 20, 40]
+        decoded_outputs = random_decoded_outputs(n_stim_patterns, n_obs_per_sp, n_output_symbols)
+        mi = plugin_mi(contingency_tables(decoded_outputs, max(n_output_symbols), n_obs_per_sp))
+        stimuli = np.repeat(np.arange(n_stim_patterns), n_obs_per_sp)
+        for decoded_output, estimate in zip(decoded_outputs, mi):
+            expected = 0
+            for x in np.unique(decoded_output):
+                for y in range(n_stim_patterns):
+                    p_xy = np.mean((decoded_output == x) & (stimuli == y))
+                    if p_xy > 0:
+                        expected += p_xy * np.log2(p_xy / (np.mean(decoded_output == x) * np.mean(stimuli == y)))
+            self.assertAlmostEqual(estimate, expected)
+    def test_independent_output(self):
+        # with plenty of data, the MI between a stimulus and an
+        # output drawn independently of it must be close to zero.
+        rng = np.random.RandomState(1)
+        n_stim_patterns, n_obs_per_sp, n = 10, 2000, 4
+        decoded_outputs = rng.randint(n, size=(3, n_stim_patterns*n_obs_per_sp))
+        tables = contingency_tables(decoded_outputs, n, n_obs_per_sp)
+        for mi in [plugin_mi(tables), pt_mi(tables, [n]*3), qe_mi(decoded_outputs, n, n_obs_per_sp, random_state=0)]:
+            self.assertTrue(np.all(np.abs(mi) < 0.01))
+    def test_deterministic_output(self):
+        # when the output is a function of the stimulus, its
+        # conditional entropy is zero and the MI is its entropy
+        # (here, log2 of the number of output symbols, as every output
+        # symbol corresponds to the same number of stimuli).
+        n_stim_patterns, n_obs_per_sp = 20, 8
+        n_output_symbols = [1, 2, 4, 5, 10, 20]
+        stimuli = np.repeat(np.arange(n_stim_patterns), n_obs_per_sp)
+        decoded_outputs = np.array([stimuli % n for n in n_output_symbols])
+        tables = contingency_tables(decoded_outputs, max(n_output_symbols), n_obs_per_sp)
+        self.assertTrue(np.allclose(plugin_mi(tables), np.log2(n_output_symbols)))
+        self.assertTrue(np.allclose(qe_mi(decoded_outputs, max(n_output_symbols), n_obs_per_sp, random_state=0), np.log2(n_output_symbols)))
+    def test_qe_seed(self):
+        decoded_outputs = random_decoded_outputs(20, 16, [3, 10, 20, 40])
+        self.assertTrue(np.array_equal(qe_mi(decoded_outputs, 40, 16, random_state=3), qe_mi(decoded_outputs, 40, 16, random_state=3)))
+
+class TestPairwiseDistances(unittest.TestCase):
+    def setUp(self):
+        # vectors far from the origin compared to their distances,
+        # with some identical and almost identical rows
+        rng = np.random.RandomState(0)
+        self.vectors = 50 + rng.normal(size=(200, 100))
+        self.vectors[10] = self.vectors[20]
+        self.vectors[30:40] = self.vectors[40]
+        self.vectors[50] = self.vectors[60] + 1e-6
+        self.expected = cdist(self.vectors, self.vectors)
+    def test_gram(self):
+        # a small memory budget forces the calculation in many blocks
+        distances = pairwise_distances(self.vectors, memory_budget=2**18, exact=False)
+        self.assertTrue(np.allclose(distances, self.expected, rtol=1e-8, atol=0))
+        self.assertTrue(np.array_equal(distances, distances.T))
+        self.assertTrue(np.all(distances[self.expected == 0] == 0))
+    def test_exact(self):
+        distances = pairwise_distances(self.vectors, memory_budget=2**18, exact=True)
+        self.assertTrue(np.allclose(distances, self.expected, rtol=1e-14, atol=0))
+        self.assertTrue(np.all(distances[self.expected == 0] == 0))
+
+@unittest.skipIf(pe is None, "pyentropy is not installed")
+class TestPyentropyAgreement(unittest.TestCase):
+    def setUp(self):
+        self.n_stim_patterns = 20
+        self.n_obs_per_sp = 16
+        self.n_output_symbols = [3, 10, 20, 40]
+        self.decoded_outputs = random_decoded_outputs(self.n_stim_patterns, self.n_obs_per_sp, self.n_output_symbols)
+        self.tables = contingency_tables(self.decoded_outputs, max(self.n_output_symbols), self.n_obs_per_sp)
+    def pyentropy_mi(self, **kwargs):
+        mi = []
+        for decoded_output, n in zip(self.decoded_outputs, self.n_output_symbols):
+            s = pe.SortedDiscreteSystem(decoded_output, (1, n), self.n_stim_patterns, np.repeat(self.n_obs_per_sp, self.n_stim_patterns))
+            s.calculate_entropies(calc=['HX', 'HXY'], **kwargs)
+            mi.append(s.I())
+        return np.array(mi)
+    def test_plugin(self):
+        self.assertTrue(np.allclose(plugin_mi(self.tables), self.pyentropy_mi(method='plugin')))
+    def test_pt(self):
+        self.assertTrue(np.allclose(pt_mi(self.tables, self.n_output_symbols), self.pyentropy_mi(method='pt', sampling='naive')))
+    def test_qe(self):
+        # qe splits the trials at random, so only compare the
+        # estimates on average over many splits. For this data a
+        # single qe estimate has a standard deviation of about 0.045
+        # bits across splits, so the difference of two averages over
+        # 100 splits has a standard deviation of about 0.0065 bits.
+        n_splits = 100
+        qe = np.mean([qe_mi(self.decoded_outputs, max(self.n_output_symbols), self.n_obs_per_sp, random_state=seed) for seed in range(n_splits)], axis=0)
+        # pyentropy draws its splits from numpy's global generator
+        np.random.seed(0)
+        pyentropy_qe = np.mean([self.pyentropy_mi(method='qe', sampling='naive', qe_method='plugin') for each in range(n_splits)], axis=0)
+        self.assertTrue(np.allclose(qe, pyentropy_qe, rtol=0, atol=0.03))
+
+if __name__ == '__main__':
+    unittest.main()
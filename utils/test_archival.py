@@ -0,0 +1,213 @@
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from archival import SpikesArchive, ResultsArchive, ResultsIndex, CompressionPolicy, create_chunked_spike_dataset, create_csr_spike_datasets, append_csr_spikes, dense_to_csr_spikes, read_csr_trains
+
+class ArchivePoint(object):
+    """Stand-in for a ParameterSpacePoint, carrying only what the
+    archives need."""
+    SIM_DECORRELATION_TIME = 30
+    def __init__(self, spike_archive_path, n_stim_patterns, n_trials, sim_duration, ana_duration):
+        self.spike_archive_path = spike_archive_path
+        self.n_stim_patterns = n_stim_patterns
+        self.n_trials = n_trials
+        self.sim_duration = sim_duration
+        self.ana_duration = ana_duration
+        self.sim_transient_time = sim_duration - ana_duration
+
+class ResultsPoint(object):
+    """Stand-in for a ParameterSpacePoint, carrying only what the
+    results archive and index need. Points that only differ in
+    training_size share the same results archive file."""
+    n_stim_patterns = 4
+    n_trials = 10
+    sim_duration = 150.
+    ana_duration = 50.
+    multineuron_metric_mixing = 0.
+    linkage_method_string = 'ward'
+    tau = 5
+    def __init__(self, base_dir, training_size):
+        self.BASE_DIR = base_dir
+        self.data_folder_path = base_dir
+        self.training_size = training_size
+        self.results_arch = ResultsArchive(self)
+    def __repr__(self):
+        return 'ResultsPoint({0!r}, {1!r})'.format(self.BASE_DIR, self.training_size)
+    def store_results(self, value):
+        with self.results_arch.batch():
+            for ds in ResultsArchive.datasets:
+                if ds.startswith('ts_'):
+                    self.results_arch.update_result(ds, data=value + np.arange(self.n_stim_patterns * self.n_trials, dtype=float))
+                else:
+                    self.results_arch.update_result(ds, data=value)
+
+def random_dense_spikes(rng, n_cells, duration, rate=0.05):
+    """A (max_n_spikes, n_cells) array of spike times padded with -1,
+    as recorded by the simulations. Some cells are silent."""
+    n_spikes = rng.poisson(rate * duration, size=n_cells)
+    n_spikes[::5] = 0
+    spikes = -np.ones((n_spikes.max(), n_cells), dtype=np.float32)
+    for cell, n in enumerate(n_spikes):
+        spikes[:n,cell] = np.sort(rng.uniform(0, duration, size=n))
+    return spikes
+
+class TestCSRSpikeArchive(unittest.TestCase):
+    n_stim_patterns = 3
+    n_archive_trials = 2
+    n_cells = {'mf': 7, 'grc': 11}
+    # the archive trials are long enough to be sliced in up to 4
+    # observations of the longest analysis window below
+    archive_sim_duration = 150. + 3 * (50. + ArchivePoint.SIM_DECORRELATION_TIME)
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dense_path = os.path.join(self.directory, 'dense.hdf5')
+        self.csr_path = os.path.join(self.directory, 'csr.hdf5')
+        rng = np.random.RandomState(0)
+        self.spikes = dict(((spn, trial, cell_type), random_dense_spikes(rng, n_cells, self.archive_sim_duration))
+                           for spn in range(self.n_stim_patterns)
+                           for trial in range(self.n_archive_trials)
+                           for cell_type, n_cells in self.n_cells.items())
+        # the network is completely silent in one archive trial
+        self.spikes[(1, 0, 'grc')] = np.zeros((0, self.n_cells['grc']), dtype=np.float32)
+        for path, layout in [(self.dense_path, 'dense'), (self.csr_path, 'csr')]:
+            archive = h5py.File(path, 'w')
+            archive.attrs['n_stim_patterns'] = self.n_stim_patterns
+            archive.attrs['n_trials'] = self.n_archive_trials
+            archive.attrs['sim_duration'] = self.archive_sim_duration
+            for cell_type, n_cells in self.n_cells.items():
+                archive.attrs['n_'+cell_type] = n_cells
+            if layout == 'csr':
+                archive.attrs['spike_layout'] = 'csr'
+                for cell_type, n_cells in self.n_cells.items():
+                    create_csr_spike_datasets(archive, cell_type, n_cells)
+            for spn in range(self.n_stim_patterns):
+                for trial in range(self.n_archive_trials):
+                    for cell_type in self.n_cells:
+                        spikes = self.spikes[(spn, trial, cell_type)]
+                        if layout == 'csr':
+                            append_csr_spikes(archive, cell_type, spikes)
+                        else:
+                            group = archive.require_group('{0:03d}/{1:02d}'.format(spn, trial))
+                            create_chunked_spike_dataset(group, cell_type+'_spiketimes', spikes)
+            archive.close()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def expected_counts(self, point, cell_type):
+        slices_per_trial = int(1 + (self.archive_sim_duration - point.sim_duration)//(point.ana_duration + point.SIM_DECORRELATION_TIME))
+        counts = np.zeros((point.n_stim_patterns * point.n_trials, self.n_cells[cell_type]))
+        for spn in range(point.n_stim_patterns):
+            for trial in range(point.n_trials):
+                spikes = self.spikes[(spn, trial // slices_per_trial, cell_type)]
+                slice_start = point.sim_transient_time + (trial % slices_per_trial) * (point.ana_duration + point.SIM_DECORRELATION_TIME)
+                counts[spn*point.n_trials + trial] = np.sum((spikes > slice_start) & (spikes < slice_start + point.ana_duration), axis=0)
+        return counts
+    def test_slicing_configurations(self):
+        # (n_stim_patterns, n_trials, sim_duration, ana_duration):
+        # unsliced archive trials, archive trials sliced in several
+        # observations, partly used archive trials and stimulus
+        # patterns
+        configurations = [(3, 2, self.archive_sim_duration, 50.),
+                          (3, 8, 150., 50.),
+                          (2, 5, 150., 50.),
+                          (3, 3, 100., 20.),
+                          (1, 1, 150., 50.)]
+        for n_stim_patterns, n_trials, sim_duration, ana_duration in configurations:
+            counts = {}
+            trains = {}
+            for layout, path in [('dense', self.dense_path), ('csr', self.csr_path)]:
+                spikes_arch = SpikesArchive(ArchivePoint(path, n_stim_patterns, n_trials, sim_duration, ana_duration))
+                for cell_type in self.n_cells:
+                    counts[(layout, cell_type)] = spikes_arch.get_spike_counts(cell_type, use_cache=False)
+                    trains[(layout, cell_type)] = spikes_arch.get_spike_trains(cell_type)
+            point = ArchivePoint(None, n_stim_patterns, n_trials, sim_duration, ana_duration)
+            for cell_type in self.n_cells:
+                expected = self.expected_counts(point, cell_type)
+                self.assertTrue(np.array_equal(counts[('dense', cell_type)], expected))
+                self.assertTrue(np.array_equal(counts[('csr', cell_type)], expected))
+                dense_times, dense_indptr = trains[('dense', cell_type)]
+                csr_times, csr_indptr = trains[('csr', cell_type)]
+                self.assertTrue(np.array_equal(dense_indptr, csr_indptr))
+                self.assertTrue(np.array_equal(dense_times, csr_times))
+                self.assertTrue(np.array_equal(np.diff(csr_indptr), expected.ravel()))
+    def test_delta_encoding(self):
+        resolution = 0.01
+        path = os.path.join(self.directory, 'delta.hdf5')
+        archive = h5py.File(path, 'w')
+        create_csr_spike_datasets(archive, 'grc', self.n_cells['grc'], CompressionPolicy(delta=True, resolution=resolution))
+        observations = [self.spikes[(spn, trial, 'grc')] for spn in range(self.n_stim_patterns) for trial in range(self.n_archive_trials)]
+        for spikes in observations:
+            append_csr_spikes(archive, 'grc', spikes)
+        n_trains = len(observations) * self.n_cells['grc']
+        times, indptr = read_csr_trains(archive['spikes/grc'], 0, n_trains)
+        # reading from the middle of the archive gives the same trains
+        middle_times, middle_indptr = read_csr_trains(archive['spikes/grc'], self.n_cells['grc'] + 3, n_trains - 2)
+        archive.close()
+        expected_times = np.concatenate([dense_to_csr_spikes(spikes)[0] for spikes in observations])
+        expected_counts = np.concatenate([np.sum(spikes > 0, axis=0) for spikes in observations])
+        self.assertTrue(np.array_equal(np.diff(indptr), expected_counts))
+        # times are rounded to the resolution, and read back as 32-bit
+        # floats
+        tolerance = resolution / 2. + np.spacing(np.float32(self.archive_sim_duration))
+        self.assertTrue(np.all(np.abs(times - expected_times) <= tolerance))
+        self.assertTrue(np.array_equal(middle_times, times[middle_indptr[0]:middle_indptr[-1]]))
+
+class TestResultsIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = ResultsIndex(self.directory)
+        self.points = [ResultsPoint(self.directory, training_size) for training_size in (3, 5)]
+        for value, p in enumerate(self.points):
+            p.store_results(float(value))
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def assertResultsEqual(self, indexed_results, point):
+        for ds in ResultsArchive.datasets:
+            self.assertTrue(np.array_equal(indexed_results[ds], getattr(point, ds)))
+    def test_update_and_load(self):
+        self.index.update(self.points)
+        indexed_results = self.index.load()
+        self.assertEqual(sorted(indexed_results), sorted(repr(p) for p in self.points))
+        for p in self.points:
+            self.assertResultsEqual(indexed_results[repr(p)], p)
+        self.assertEqual(self.index.stale_points(self.points, indexed_results), [])
+    def test_staleness(self):
+        self.index.update(self.points)
+        # make sure the new results stamp differs from the old one
+        time.sleep(0.01)
+        self.points[0].store_results(10.)
+        # the points share the same results archive file, but only the
+        # rewritten point is stale
+        indexed_results = self.index.load()
+        self.assertEqual(self.index.stale_points(self.points, indexed_results), [self.points[0]])
+        # updating the index replaces the stale row
+        self.index.update([self.points[0]])
+        indexed_results = self.index.load()
+        self.assertEqual(len(indexed_results), len(self.points))
+        self.assertResultsEqual(indexed_results[repr(self.points[0])], self.points[0])
+        self.assertEqual(self.index.stale_points(self.points, indexed_results), [])
+    def test_rows_without_stamp_are_stale(self):
+        self.index.update(self.points)
+        indexed_results = self.index.load()
+        del indexed_results[repr(self.points[1])][ResultsArchive.stamp_attribute]
+        self.assertEqual(self.index.stale_points(self.points, indexed_results), [self.points[1]])
+    def test_missing_results_are_stale(self):
+        self.index.update(self.points)
+        indexed_results = self.index.load()
+        os.remove(self.points[0].results_arch.path)
+        self.assertEqual(self.index.stale_points(self.points, indexed_results), self.points)
+    def test_empty_index(self):
+        self.assertEqual(self.index.load(), {})
+        # an index file left empty by an interrupted writer
+        open(self.index.path, 'w').close()
+        self.assertEqual(self.index.load(), {})
+        self.index.update(self.points[:1])
+        self.assertEqual(list(self.index.load()), [repr(self.points[0])])
+
+if __name__ == '__main__':
+    unittest.main()
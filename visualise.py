@@ -67,7 +67,7 @@ sim_duration = psl(180)
 ana_duration = psl(30) # must be < min(sim_duration)
 training_size = psl(30) # must be < min(n_trials)
 multineuron_metric_mixing = psl(0.)
-linkage_method = psl(1) # 0: ward, 1: kmeans
+linkage_method = psl(1) # 0: ward, 1: kmeans, 2: mini-batch kmeans, 3: kmeans started from class means
 tau = psl(5)
 dt = psl(2)
 